@@ -0,0 +1,441 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the render and queue hot paths of labelprint.
+
+Each benchmark reports labels per second and the median and 99th
+percentile latency. Results can be saved as JSON and compared against an
+earlier run:
+
+    ./bench.py -o before.json
+    ... change things ...
+    ./bench.py -c before.json
+
+Nothing is printed for real: the dispatch benchmark feeds messages to
+the AMQP listener through an in-process stand-in for the channel, and the
+print jobs end in a sink that discards the rasters.
+The stand-ins for AMQP are also used by the tests.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import tempfile
+import contextlib
+import subprocess
+
+import click
+import trio
+import cairo
+import PIL.Image
+from gi.repository import GLib
+
+import code128
+import jobqueue
+import labelprint
+from labelprint import LabelPrinter, LabelUI, Daemon, Listener, LocalListener
+
+WIDTHS = (38, 50, 62)
+TEXTS = {
+    "short": "Bin A3",
+    "long": "Assorted stainless steel hex bolts M6x40",
+    "multi": "Shelf 12\nScrews M4\nBox 3 of 7",
+}
+BARCODES = ("12345678", "A-1234-XYZ", "SKU00042117")
+
+def clear_caches():
+    labelprint.barcode_cache.clear()
+    labelprint.label_cache.clear()
+    labelprint.block_cache.clear()
+    labelprint.image_cache.clear()
+    labelprint.raster_cache.clear()
+
+def make_cold(prn):
+    """Make @prn lay out its next label from scratch: besides the caches,
+    its blocks remember what they show, and the fitter line widths"""
+    clear_caches()
+    for block in prn.blocks:
+        block.key = None
+        block.dirty = True
+    prn.fitter._widths.clear()
+    prn._need_reflow = True
+
+def timed(name, fn, n, setup=None):
+    """Call @fn @n times; return statistics about it"""
+    times = []
+    for i in range(n):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - t)
+    return stats(name, times)
+
+def stats(name, times):
+    times = sorted(times)
+    total = sum(times)
+    n = len(times)
+    return dict(
+        name=name,
+        n=n,
+        per_sec=n/total if total else None,
+        p50_ms=times[n//2]*1000,
+        p99_ms=times[min(n-1, int(n*0.99))]*1000,
+    )
+
+def bench_pil2cairo(n):
+    im = PIL.Image.new("RGBA", (400, 120), (0, 0, 0, 255))
+    asset = labelprint.Asset("bench", im)
+    return [timed("pil2cairo 400x120", lambda i: labelprint.pil2cairo(im), n),
+        timed("get_image 200x60 (cached)", lambda i: labelprint.get_image(asset, 200, 60), n)]
+
+def bench_barcode(n):
+    res = []
+    for code in BARCODES:
+        res.append(timed("code128 %s" % (code,), lambda i: code128.bars(code), n))
+        res.append(timed("get_bars %s (cold)" % (code,),
+            lambda i: labelprint.get_bars(code, 1000, 3), n, setup=clear_caches))
+    return res
+
+def bench_gen_page(n):
+    res = []
+    for width in WIDTHS:
+        prn = LabelPrinter(None)
+        prn.set_width(width)
+        for kind, text in TEXTS.items():
+            prn.set_barcode(BARCODES[0])
+            prn.set_text(text)
+            def run(i):
+                surface = cairo.RecordingSurface(cairo.Content.COLOR, None)
+                prn.gen_page(cairo.Context(surface))
+            res.append(timed("gen_page %dmm %s (cold)" % (width, kind), run, n,
+                setup=lambda: make_cold(prn)))
+            res.append(timed("gen_page %dmm %s (cached)" % (width, kind), run, n))
+    return res
+
+def bench_reflow(n):
+    res = []
+    prn = LabelPrinter(None)
+    for width in WIDTHS:
+        prn.set_width(width)
+        def run(i):
+            prn.set_barcode(BARCODES[i % len(BARCODES)])
+            prn.set_text(TEXTS["multi"])
+            prn.reflow()
+        res.append(timed("reflow %dmm (cold)" % (width,), run, n, setup=lambda: make_cold(prn)))
+        res.append(timed("reflow %dmm (cached)" % (width,), run, n))
+    return res
+
+def bench_rasterize(n):
+    res = []
+    for dpi in (203, 300):
+        prn = LabelPrinter(None)
+        prn.set_width(WIDTHS[1])
+        prn.set_dpi(dpi)
+        def run(i):
+            prn.set_barcode(BARCODES[i % len(BARCODES)])
+            prn.set_text(TEXTS["multi"])
+            prn.reflow()
+            prn.rasterize()
+        res.append(timed("rasterize %d dpi (cold)" % (dpi,), run, n, setup=lambda: make_cold(prn)))
+        res.append(timed("rasterize %d dpi (cached)" % (dpi,), run, n))
+    return res
+
+class NullSink:
+    """Stands in for a printer"""
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+class _Widget:
+    def set_text(self, *a):
+        pass
+
+    def queue_draw(self):
+        pass
+
+class BenchUI(LabelUI):
+    """A LabelUI without any widgets"""
+    def __init__(self):
+        super(LabelUI, self).__init__()
+        self.prn = LabelPrinter(self)
+        self.prn.raw = NullSink()
+        self.prn.set_dpi(labelprint.RAW_DPI)
+        self.data = jobqueue.JobQueue(on_ready=self._ready)
+        self.done = []
+        self._widget = _Widget()
+
+    def __getitem__(self, name):
+        return self._widget
+
+    def check_print_job(self):
+        self.done.append(time.perf_counter())
+        super().check_print_job()
+
+class _Obj:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class FakeChannel:
+    """Stands in for a trio_amqp channel"""
+    def __init__(self, broker=None):
+        self.broker = broker
+        self.published = []
+        self.acked = []
+
+    async def basic_publish(self, payload, exchange_name, routing_key, properties=None, **kw):
+        if self.broker is not None:
+            self.broker.publish(self, routing_key, payload)
+        self.published.append((routing_key, payload, properties))
+
+    async def basic_client_ack(self, delivery_tag, **kw):
+        if self.broker is not None:
+            self.broker.ack(self, delivery_tag)
+        self.acked.append(delivery_tag)
+
+    async def exchange_declare(self, *a, **kw):
+        pass
+
+    async def queue_declare(self, queue_name=None, **kw):
+        return dict(queue=queue_name or "amq.gen-%d" % (id(self),))
+
+    async def queue_bind(self, *a, **kw):
+        pass
+
+    async def basic_qos(self, **kw):
+        pass
+
+    def new_consumer(self, queue_name):
+        return self.broker.consume(queue_name)
+
+class FakeBroker:
+    """Stands in for an AMQP broker: pass its connect to a Listener.
+
+    Messages put into a queue are delivered to whoever consumes from it.
+    drop() cuts the connection; messages it did not acknowledge are
+    delivered again, under new tags.
+    """
+    def __init__(self):
+        self._queues = {}
+        self._tags = iter(range(1, 1<<62))
+        self.delivered = {} # delivery tag: time
+        self.acked = {}
+        self.published = [] # (routing key, body) of replies
+        self.connections = 0
+        self._all_acked = None
+        self._want = 0
+        self._unacked = {} # delivery tag: (queue, body, envelope, properties)
+        self._channel = None
+        self._scope = None
+
+    def _queue(self, name):
+        q = self._queues.get(name)
+        if q is None:
+            q = self._queues[name] = trio.open_memory_channel(math.inf)
+        return q
+
+    def put(self, queue, body, routing_key=None, reply_to=None):
+        self._send(queue, body, routing_key or queue,
+            _Obj(reply_to=reply_to, correlation_id=reply_to and "c%d" % (next(self._tags),)))
+
+    def _send(self, queue, body, routing_key, properties):
+        self._queue(queue)[0].send_nowait((queue, body,
+            _Obj(delivery_tag=next(self._tags), routing_key=routing_key), properties))
+
+    def publish(self, channel, routing_key, body):
+        if channel is not self._channel:
+            raise ConnectionError("channel is closed")
+        self.published.append((routing_key, body))
+
+    def ack(self, channel, tag):
+        if channel is not self._channel:
+            raise ConnectionError("channel is closed")
+        del self._unacked[tag]
+        self.acked[tag] = time.perf_counter()
+        if self._all_acked is not None and len(self.acked) >= self._want:
+            self._all_acked.set()
+
+    async def wait_acked(self, n):
+        self._want = n
+        self._all_acked = trio.Event()
+        if len(self.acked) < n:
+            await self._all_acked.wait()
+
+    def unacked(self):
+        return len(self._unacked)
+
+    def drop(self):
+        """Cut the connection, as a broker restart would"""
+        self._channel = None
+        for queue, body, envelope, properties in self._unacked.values():
+            self._send(queue, body, envelope.routing_key, properties)
+        self._unacked = {}
+        self._scope.cancel()
+
+    @contextlib.asynccontextmanager
+    async def consume(self, name):
+        async def deliver():
+            async for queue, body, envelope, properties in self._queue(name)[1]:
+                self.delivered[envelope.delivery_tag] = time.perf_counter()
+                self._unacked[envelope.delivery_tag] = (queue, body, envelope, properties)
+                yield body, envelope, properties
+        yield deliver()
+
+    @contextlib.asynccontextmanager
+    async def connect(self, **kw):
+        self.connections += 1
+        with trio.CancelScope() as self._scope:
+            yield self
+
+    @contextlib.asynccontextmanager
+    async def new_channel(self):
+        self._channel = FakeChannel(self)
+        yield self._channel
+
+def bench_dispatch(n, per_message=1):
+    """AMQP message in, through the queue, to the (fake) printer"""
+    clear_caches()
+    ui = BenchUI()
+    listener = Listener(ui, {})
+    channel = FakeChannel()
+    received = []
+
+    async def feed():
+        for i in range(0, n, per_message):
+            body = [dict(barcode="%08d" % (j % 50,), text=["Item %d" % (j % 50,), "Bin %d" % (j % 7,)])
+                for j in range(i, min(n, i+per_message))]
+            if per_message == 1:
+                body = body[0]
+            t = time.perf_counter()
+            await listener.on_request(channel, json.dumps(body).encode("utf-8"),
+                _Obj(delivery_tag=i, routing_key=""), _Obj(reply_to=None, correlation_id=None))
+            received.extend([t] * (len(body) if per_message > 1 else 1))
+
+    ctx = GLib.MainContext.default()
+    t0 = time.perf_counter()
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        trio.run(feed)
+        while len(ui.done) < n:
+            ctx.iteration(True)
+    total = time.perf_counter() - t0
+
+    res = stats("dispatch %d labels, %d per message" % (n, per_message),
+        [b-a for a,b in zip(received, ui.done)])
+    res['per_sec'] = n/total
+    return [res]
+
+def bench_consume(n, prefetch=20):
+    """Shared AMQP queue in, through the daemon's printer, acked after printing"""
+    clear_caches()
+    broker = FakeBroker()
+    ui = Daemon()
+    for w in ui.workers:
+        w.prn.raw = NullSink()
+        w.prn.set_dpi(labelprint.RAW_DPI)
+    args = dict(host="", login="", password="", vhost="", exchange="", route="",
+        queue="labels", prefetch=prefetch)
+    listener = Listener(ui, args, connect=broker.connect)
+
+    async def run():
+        for i in range(n):
+            broker.put("labels", json.dumps(dict(barcode="%08d" % (i % 50,), text=["Item %d" % (i % 50,)])).encode("utf-8"))
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(ui.run, [listener])
+            await broker.wait_acked(n)
+            nursery.cancel_scope.cancel()
+
+    t0 = time.perf_counter()
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        trio.run(run)
+    total = time.perf_counter() - t0
+
+    res = stats("consume %d labels, prefetch %d" % (n, prefetch),
+        [broker.acked[tag] - t for tag, t in broker.delivered.items()])
+    res['per_sec'] = n/total
+    return [res]
+
+def bench_local(n):
+    """POST a label to the local socket and wait until it is printed"""
+    clear_caches()
+    ui = Daemon()
+    for w in ui.workers:
+        w.prn.raw = NullSink()
+        w.prn.set_dpi(labelprint.RAW_DPI)
+    path = os.path.join(tempfile.mkdtemp(), "labelprint.sock")
+    times = []
+
+    async def post(i):
+        body = json.dumps(dict(barcode="%08d" % (i % 50,), text=["Item %d" % (i % 50,)])).encode("utf-8")
+        stream = await trio.open_unix_socket(path)
+        async with stream:
+            await stream.send_all(b"POST /print?wait=1 HTTP/1.0\r\nContent-Length: %d\r\n\r\n" % (len(body),) + body)
+            while await stream.receive_some(65536):
+                pass
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            await nursery.start(ui.run, [LocalListener(ui, path)])
+            for i in range(n):
+                t = time.perf_counter()
+                await post(i)
+                times.append(time.perf_counter() - t)
+            nursery.cancel_scope.cancel()
+
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        trio.run(run)
+    return [stats("local socket, wait for print", times)]
+
+BENCHES = {
+    "pil2cairo": bench_pil2cairo,
+    "barcode": bench_barcode,
+    "gen_page": bench_gen_page,
+    "reflow": bench_reflow,
+    "rasterize": bench_rasterize,
+    "dispatch": lambda n: bench_dispatch(n) + bench_dispatch(n, 50),
+    "consume": bench_consume,
+    "local": bench_local,
+}
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    old = {r['name']: r for r in old['results']}
+    for r in new['results']:
+        o = old.get(r['name'])
+        if o is None or not o['per_sec'] or not r['per_sec']:
+            continue
+        print("%-40s %10.1f/s %+7.1f%%   p99 %8.2f ms (was %.2f)" % (r['name'], r['per_sec'],
+            (r['per_sec']/o['per_sec'] - 1)*100, r['p99_ms'], o['p99_ms']))
+
+@click.command()
+@click.option('-n','--count', type=int, default=200, help="Iterations per benchmark")
+@click.option('-o','--output', type=click.File('w'), help="Save the results as JSON")
+@click.option('-c','--compare', 'compare_to', type=click.File('r'), help="Compare with earlier results")
+@click.argument('only', nargs=-1, type=click.Choice(sorted(BENCHES)))
+def main(count, output, compare_to, only):
+    """Run the benchmarks (or ONLY some of them)."""
+    results = []
+    for name in (only or BENCHES):
+        for r in BENCHES[name](count):
+            print("%-40s %10.1f/s   p50 %8.2f ms   p99 %8.2f ms" % (r['name'], r['per_sec'] or 0, r['p50_ms'], r['p99_ms']),
+                file=sys.stderr)
+            results.append(r)
+    res = dict(revision=revision(), python=sys.version.split()[0], count=count, results=results)
+
+    if output is not None:
+        json.dump(res, output, indent=2)
+    if compare_to is not None:
+        compare(json.load(compare_to), res)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+A Code 128 encoder.
+
+This only computes where the bars go; drawing them is up to the caller.
+Runs of digits are packed two per symbol with code set C, everything else
+uses code set B, which covers printable ASCII.
+"""
+
+# Widths of bar, space, bar, space, bar, space (stop: plus a final bar),
+# indexed by symbol value.
+PATTERNS = (
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312",
+    "132212", "221213", "221312", "231212", "112232", "122132", "122231", "113222",
+    "123122", "123221", "223211", "221132", "221231", "213212", "223112", "312131",
+    "311222", "321122", "321221", "312212", "322112", "322211", "212123", "212321",
+    "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121",
+    "313121", "211331", "231131", "213113", "213311", "213131", "311123", "311321",
+    "331121", "312113", "312311", "332111", "314111", "221411", "431111", "111224",
+    "111422", "121124", "121421", "141122", "141221", "112214", "112412", "122114",
+    "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112",
+    "421211", "212141", "214121", "412121", "111143", "111341", "131141", "114113",
+    "114311", "411113", "411311", "113141", "114131", "311141", "411131", "211412",
+    "211214", "211232", "2331112",
+)
+
+CODE_C = 99
+CODE_B = 100
+START_B = 104
+START_C = 105
+STOP = 106
+
+QUIET = 10 # modules of white space required on either side
+
+def _digits(data, i):
+    """Length of the run of digits at data[i:]"""
+    n = i
+    while n < len(data) and '0' <= data[n] <= '9':
+        n += 1
+    return n - i
+
+def encode(data):
+    """Return the symbol values for @data, including start, checksum and stop.
+
+    Code set C is used for leading runs of four or more digits, trailing
+    runs of four or more, and inner runs of six or more.
+    """
+    for c in data:
+        if not 32 <= ord(c) <= 127:
+            raise ValueError("Code128 cannot encode %r" % (c,))
+
+    i = 0
+    n = _digits(data, 0)
+    if n >= 4 or (n == len(data) and n >= 2 and n % 2 == 0):
+        res = [START_C]
+        cset = 'C'
+    else:
+        res = [START_B]
+        cset = 'B'
+
+    while i < len(data):
+        if cset == 'C':
+            if _digits(data, i) >= 2:
+                res.append(int(data[i:i+2]))
+                i += 2
+                continue
+            res.append(CODE_B)
+            cset = 'B'
+
+        n = _digits(data, i)
+        if n >= 4 and (i+n == len(data) or n >= 6):
+            if n % 2:
+                res.append(ord(data[i]) - 32)
+                i += 1
+            res.append(CODE_C)
+            cset = 'C'
+        else:
+            res.append(ord(data[i]) - 32)
+            i += 1
+
+    check = res[0]
+    for pos, val in enumerate(res[1:], 1):
+        check += pos * val
+    res.append(check % 103)
+    res.append(STOP)
+    return res
+
+def bars(data):
+    """Return a list of (offset, width) bars in modules, plus the total
+    width of the symbol in modules (without quiet zones)."""
+    res = []
+    pos = 0
+    for val in encode(data):
+        bar = True
+        for w in PATTERNS[val]:
+            w = int(w)
+            if bar:
+                res.append((pos, w))
+            pos += w
+            bar = not bar
+    return res, pos
@@ -0,0 +1,123 @@
+"""
+A thread-safe priority queue of print jobs.
+
+Labels are queued by the AMQP thread and taken by whoever prints them.
+Jobs with a higher priority go first; jobs of the same priority go in
+the order they came. The priority of a record is its "priority" or
+"cups-job-priority" field, 1 to 100 like the CUPS option, default 50.
+
+The queue calls its @on_ready function when jobs arrive, but only once
+until the consumer takes some: a burst of messages costs one wakeup, and
+the consumer drains as much as it likes with get(). The queue has a
+nominal size; put() always accepts a whole message, and producers are
+expected to wait_space() before receiving the next one.
+"""
+
+import heapq
+import itertools
+import threading
+
+DEFAULT_PRIORITY = 50
+PRIORITY_FIELDS = ('priority', 'cups-job-priority')
+
+def priority(rec):
+    """The priority of record @rec"""
+    for k in PRIORITY_FIELDS:
+        v = rec.get(k)
+        if v is None or v == "":
+            continue
+        try:
+            return max(1, min(100, int(v)))
+        except (TypeError, ValueError):
+            raise ValueError("Bad %s: %r" % (k, v))
+    return DEFAULT_PRIORITY
+
+class JobQueue:
+    def __init__(self, maxsize=0, on_ready=None):
+        self.maxsize = maxsize
+        self.on_ready = on_ready
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+        self._notified = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __bool__(self):
+        return bool(self._heap)
+
+    def __repr__(self):
+        return "<JobQueue of %d>" % (len(self._heap),)
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._heap)
+
+    def put(self, data):
+        """Queue the records in @data"""
+        # fail before queueing any
+        prios = [getattr(rec, 'priority', None) or priority(rec) for rec in data]
+        with self._lock:
+            for prio, rec in zip(prios, data):
+                heapq.heappush(self._heap, (-prio, next(self._seq), rec))
+            notify = bool(self._heap) and not self._notified
+            if notify:
+                self._notified = True
+        if notify and self.on_ready is not None:
+            self.on_ready()
+
+    def get(self, n=1):
+        """Take up to @n records, most urgent first"""
+        with self._lock:
+            res = [heapq.heappop(self._heap)[2] for _ in range(min(n, len(self._heap)))]
+            self._notified = False
+            self._space.notify_all()
+        return res
+
+    def get_while(self, pred, n):
+        """Take up to @n records from the front as long as @pred(record)"""
+        res = []
+        with self._lock:
+            while self._heap and len(res) < n and pred(self._heap[0][2]):
+                res.append(heapq.heappop(self._heap)[2])
+            if res:
+                self._space.notify_all()
+        return res
+
+    def peek(self, n=1):
+        """The next @n records, without taking them"""
+        with self._lock:
+            return [e[2] for e in heapq.nsmallest(n, self._heap)]
+
+    def wait_space(self, timeout=None):
+        """Block until the queue isn't full. Returns False on timeout."""
+        with self._space:
+            return self._space.wait_for(lambda: not self.full(), timeout)
+
+    def remove(self, pred):
+        """Take out the records for which @pred(record) is true"""
+        with self._lock:
+            res = [e[2] for e in sorted(self._heap) if pred(e[2])]
+            if res:
+                self._heap = [e for e in self._heap if not pred(e[2])]
+                heapq.heapify(self._heap)
+                self._space.notify_all()
+        return res
+
+    def clear(self):
+        with self._lock:
+            res = [e[2] for e in sorted(self._heap)]
+            self._heap = []
+            self._notified = False
+            self._space.notify_all()
+        return res
+
+    def stats(self):
+        """Depth, in total and per priority"""
+        with self._lock:
+            prios = [-e[0] for e in self._heap]
+        by_prio = {}
+        for p in prios:
+            by_prio[p] = by_prio.get(p, 0) + 1
+        return dict(depth=len(prios), maxsize=self.maxsize, priorities=by_prio)
@@ -17,34 +17,85 @@ Alexander Larsson (C version)
 Gustavo Carneiro (Python translation)
 """
 
-import gi
-gi.require_version('Gtk', '3.0')
-gi.require_version('PangoCairo', '1.0')
-from gi.repository import Gtk, Pango, GObject, Gdk, Gio, PangoCairo, GLib, GdkPixbuf
-Gdk.threads_init()
-
-try:
-    import trio
-    import trio_amqp
-    import threading
-except ImportError:
-    threading = None
+import time
+STARTED = time.monotonic()
+
+import threading
+import importlib
+import importlib.util
 import click
 import sys
+import os
 import math
 import cairo
 import json
-import PIL
-import PIL.ImageOps
-import PIL.ImageChops
-import barcode as pybars
 import io
-from barcode.writer import ImageWriter
-if ImageWriter is None:
-    raise RuntimeError("You need to install PIL")
-SCALE = float(Pango.SCALE)
+import re
+import base64
+import hashlib
+import subprocess
+import socket
+import stat
+import urllib.parse
+import traceback
+import itertools
+import concurrent.futures
+from collections import OrderedDict
+import records
+import code128
+import raster
+import metrics
+import jobqueue
+import templates
+import tracing
+
+class LazyModule:
+    """A module that is imported when it is first used.
+
+    Gtk and friends take a while to load, and much of this program (the
+    daemon, rendering to files) needs only some of them, or none.
+    """
+    def __init__(self, name, version=None):
+        self._name = name
+        self._version = version
+        self._mod = None
+
+    def __getattr__(self, attr):
+        mod = self._mod
+        if mod is None:
+            mod = self._load()
+        return getattr(mod, attr)
+
+    def _load(self):
+        if self._version is not None:
+            import gi
+            gi.require_version(self._name.rsplit('.',1)[1], self._version)
+        self._mod = importlib.import_module(self._name)
+        return self._mod
+
+def importable(name):
+    return importlib.util.find_spec(name) is not None
+
+Gtk = LazyModule('gi.repository.Gtk', '3.0')
+Gdk = LazyModule('gi.repository.Gdk', '3.0')
+Pango = LazyModule('gi.repository.Pango', '1.0')
+PangoCairo = LazyModule('gi.repository.PangoCairo', '1.0')
+GObject = LazyModule('gi.repository.GObject', '2.0')
+GLib = LazyModule('gi.repository.GLib', '2.0')
+trio = LazyModule('trio')
+trio_amqp = LazyModule('trio_amqp')
+PILImage = LazyModule('PIL.Image')
+SCALE = 1024.0 # Pango.SCALE, without loading Pango
 RES_I = 72
-RES = RES_I/2.54 # dots per mm
+RES = RES_I/2.54 # dots per mm, unless the printer's resolution is known
+RAW_DPI = 203 # of raw printers, unless configured
+PT = 72/25.4 # PDF points per mm
+
+# print settings of the last printer we found, so that we don't need to
+# look for it again when restarting
+SETTINGS_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'labelprint', 'print-settings.ini')
+startup_budget = None # seconds until we accept labels; complain when exceeded
 INIT_FONTSIZE=200
 
 SETTINGS = {
@@ -78,26 +129,87 @@ SETTINGS = {
 
 # https://stackoverflow.com/questions/7610159/convert-pil-image-to-cairo-imagesurface
 def pil2cairo(im):
-    """Transform a PIL Image into a Cairo ImageSurface."""
+    """Transform a PIL Image into a Cairo ImageSurface.
 
-    import sys
-    import array
+    Pillow premultiplies the alpha of an RGBA image while it packs it
+    into cairo's ARGB32 byte order, so that takes a single pass. The
+    result is copied once, into the surface's own memory.
+    """
     assert sys.byteorder == 'little', 'We don\'t support big endian'
-    if im.mode != 'RGBA':
-        im = im.convert('RGBA')
-
-    s = im.tobytes('raw', 'BGRA')
-    a = array.array('B', s)
-    dest = cairo.ImageSurface(cairo.FORMAT_ARGB32, im.size[0], im.size[1])
-    ctx = cairo.Context(dest)
-    ctx.set_antialias(cairo.ANTIALIAS_NONE)
-    non_premult_src_wo_alpha = cairo.ImageSurface.create_for_data(
-        a, cairo.FORMAT_RGB24, im.size[0], im.size[1])
-    non_premult_src_alpha = cairo.ImageSurface.create_for_data(
-        a, cairo.FORMAT_ARGB32, im.size[0], im.size[1])
-    ctx.set_source_surface(non_premult_src_wo_alpha)
-    ctx.mask_surface(non_premult_src_alpha)
-    return dest
+    with tracing.span("pil2cairo", mode=im.mode, size=im.size):
+        if im.mode != 'RGBA':
+            im = im.convert('RGBA')
+        w, h = im.size
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        surface.flush()
+        surface.get_data()[:] = im.tobytes('raw', 'BGRa', surface.get_stride())
+        surface.mark_dirty()
+        return surface
+
+class LRUCache:
+    """A bounded, thread-safe least-recently-used cache.
+
+    Old entries are dropped when there are more than @max_entries of
+    them, or when their combined size exceeds @max_size.
+    """
+    def __init__(self, max_entries=1000, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        # does not count as a hit or miss, nor refresh the entry
+        return key in self._data
+
+    def get(self, key):
+        """Return the value stored for @key, or None"""
+        with self._lock:
+            try:
+                value,_ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=1):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._data[key] = (value, size)
+            self.size += size
+            self._trim()
+
+    def resize(self, max_entries=None, max_size=None):
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_size is not None:
+                self.max_size = max_size
+            self._trim()
+
+    def _trim(self):
+        while self._data and (len(self._data) > self.max_entries or
+                (self.max_size is not None and self.size > self.max_size)):
+            _,(_,size) = self._data.popitem(last=False)
+            self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        return dict(entries=len(self._data), size=self.size, hits=self.hits, misses=self.misses)
 
 print_text = None
 print_barcode = ""
@@ -113,72 +225,713 @@ def get_code(s):
 #   else:
     return "Code128"
 
+# Barcode bars, keyed by (symbology, data, width in pixels).
+# Shared by the preview and the print path.
+barcode_cache = LRUCache(max_entries=5000, max_size=16<<20)
+
+def get_bars(data, width, min_module):
+    """Return a recording of @data's bars plus its width, fitted to
+    @width pixels with modules at least @min_module pixels wide.
+
+    The recording is one unit high so it can be scaled to any bar height.
+    Its surface is None if the barcode does not fit.
+    """
+    key = (get_code(data), data, width)
+    res = barcode_cache.get(key)
+    if res is not None:
+        return res
+
+    with tracing.span("barcode encode", barcode=data):
+        bars, n = code128.bars(data)
+    n += 2*code128.QUIET
+    # bars are a whole number of pixels wide
+    s = int(width / n)
+    if s < min_module:
+        res = (None, 0)
+        barcode_cache.put(key, res)
+        return res
+
+    bw = n*s
+    with tracing.span("barcode draw", bars=len(bars)):
+        surface = cairo.RecordingSurface(cairo.Content.COLOR_ALPHA, cairo.Rectangle(0,0,bw,1))
+        ctx = cairo.Context(surface)
+        ctx.set_antialias(cairo.ANTIALIAS_NONE)
+        ctx.set_source_rgb(0, 0, 0)
+        x = code128.QUIET*s
+        for pos,w in bars:
+            ctx.rectangle(x+pos*s, 0, w*s, 1)
+        ctx.fill()
+        del ctx
+
+    res = (surface, bw)
+    barcode_cache.put(key, res, 256+48*len(bars))
+    return res
+
+class Asset:
+    """An image to put on labels"""
+    def __init__(self, digest, image):
+        self.digest = digest
+        self.image = image
+
+# Assets, by where they came from
+asset_cache = LRUCache(max_entries=200, max_size=64<<20)
+
+def load_asset(ref, base="."):
+    """Load the image @ref: a file name (relative to @base, and not
+    outside it) or a data: URI with base64 contents"""
+    if ref.startswith("data:"):
+        key = hashlib.sha1(ref.encode("utf-8")).digest()
+    else:
+        # records come from the network: don't let them read any file
+        base = os.path.realpath(base)
+        path = os.path.realpath(os.path.join(base, ref))
+        if os.path.commonpath([base, path]) != base:
+            raise ValueError("Image %r is outside the asset directory" % (ref,))
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+    asset = asset_cache.get(key)
+    if asset is not None:
+        return asset
+
+    if ref.startswith("data:"):
+        meta, _, data = ref.partition(",")
+        if not meta.endswith(";base64"):
+            raise ValueError("Images in data: URIs must be base64 encoded")
+        data = base64.b64decode(data)
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+    im = PILImage.open(io.BytesIO(data))
+    im.load()
+    asset = Asset(hashlib.sha1(data).hexdigest(), im)
+    asset_cache.put(key, asset, len(data) + 4*im.size[0]*im.size[1])
+    return asset
+
+# Assets converted for cairo, keyed by (digest, width, height)
+image_cache = LRUCache(max_entries=500, max_size=32<<20)
+
+def get_image(asset, width, height):
+    """An ImageSurface of @asset scaled to @width x @height pixels"""
+    key = (asset.digest, width, height)
+    surface = image_cache.get(key)
+    if surface is None:
+        im = asset.image
+        if im.size != (width, height):
+            im = im.resize((width, height), PILImage.LANCZOS)
+        surface = pil2cairo(im)
+        image_cache.put(key, surface, 4*width*height)
+    return surface
+
+# Finished labels (recording, height, font size), keyed by
+# LabelPrinter.label_key(). Reprinting a label only replays it.
+label_cache = LRUCache(max_entries=1000, max_size=64<<20)
+
+# 1-bit labels (width, height, bytes per line, data) by label_key(),
+# resolution and row layout. Reprinting a label to a raw printer only
+# sends these again.
+raster_cache = LRUCache(max_entries=1000, max_size=32<<20)
+
+# Laid out parts of labels (see Block), keyed by what they show
+block_cache = LRUCache(max_entries=2000, max_size=32<<20)
+
+jobs_received = metrics.Counter("labelprint_jobs_received_total", "Labels received for printing")
+jobs_rejected = metrics.Counter("labelprint_jobs_rejected_total", "Messages that could not be parsed")
+jobs_coalesced = metrics.Counter("labelprint_jobs_coalesced_total", "Labels printed as extra copies of the one before")
+jobs_finished = metrics.Counter("labelprint_jobs_total", "Labels whose print job has finished, by status", ("status",))
+amqp_reconnects = metrics.Counter("labelprint_amqp_reconnects_total", "Times the AMQP connection was lost and made again")
+queue_depth = metrics.Gauge("labelprint_queue_depth", "Labels waiting to be printed")
+queue_wait = metrics.Histogram("labelprint_queue_wait_seconds", "Time from receiving a label until it is taken off the queue")
+render_time = metrics.Histogram("labelprint_render_seconds", "Time spent laying out a label (cache misses only)")
+spool_time = metrics.Histogram("labelprint_spool_seconds", "Time from starting a print job until it is done")
+total_time = metrics.Histogram("labelprint_end_to_end_seconds", "Time from receiving a label until its print job is done")
+
+startup_time = metrics.Gauge("labelprint_startup_seconds", "Time from starting until labels were accepted")
+
+CACHES = dict(barcode=barcode_cache, label=label_cache, block=block_cache,
+    image=image_cache, raster=raster_cache, asset=asset_cache)
+
+def _cache_stat(stat):
+    return lambda: {(name,): cache.stats()[stat] for name, cache in CACHES.items()}
+
+cache_hits = metrics.Counter("labelprint_cache_hits_total", "Cache lookups that found an entry", ("cache",))
+cache_hits.set_function(_cache_stat('hits'))
+cache_misses = metrics.Counter("labelprint_cache_misses_total", "Cache lookups that found nothing", ("cache",))
+cache_misses.set_function(_cache_stat('misses'))
+cache_entry_count = metrics.Gauge("labelprint_cache_entries", "Entries in a cache", ("cache",))
+cache_entry_count.set_function(_cache_stat('entries'))
+cache_bytes = metrics.Gauge("labelprint_cache_size", "Estimated memory (bytes) that a cache holds", ("cache",))
+cache_bytes.set_function(_cache_stat('size'))
+
+def report_startup(what):
+    """Note that we're ready to accept labels, if we haven't yet"""
+    if startup_time.get():
+        return
+    t = time.monotonic() - STARTED
+    startup_time.set(t)
+    print("%s after %.0f ms" % (what, t*1000), file=sys.stderr)
+    if startup_budget is not None and t > startup_budget:
+        print("That is over the startup budget of %.0f ms" % (startup_budget*1000,), file=sys.stderr)
+
+class Job(dict):
+    """A label record on its way to the printer.
+
+    Besides the record itself this carries an ID, and the time at which
+    it reached each stage (received, dequeued, render, rendered, spool,
+    done), as returned by time.monotonic().
+    """
+    _ids = itertools.count(1)
+    status = None # "ok", "failed" or "cancelled" when done
+    origin = None # the AMQP channel that delivers it again unless it is acked
+    asset = None # its image, loaded by make_jobs
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.id = next(self._ids)
+        self.priority = jobqueue.priority(self)
+        self.times = dict(received=time.monotonic())
+        self._callbacks = []
+
+    def stamp(self, stage):
+        self.times[stage] = time.monotonic()
+
+    def add_done_callback(self, fn):
+        """Call @fn(job) when the job is done, in whichever thread that
+        happens"""
+        self._callbacks.append(fn)
+
+    def set_done(self, status):
+        self.status = status
+        self.stamp('done')
+        tracing.interval("job", self.id, self.times['received'], self.times['done'],
+            barcode=self['barcode'], status=status)
+        for fn in self._callbacks:
+            try:
+                fn(self)
+            except Exception as exc:
+                print("Job %d callback: %r" % (self.id, exc), file=sys.stderr)
+
+    def report(self):
+        """What happened to this job, for the producer"""
+        def ms(start, end):
+            t = self.elapsed(start, end)
+            return None if t is None else round(t*1000, 1)
+        return dict(id=self.id, barcode=self['barcode'], status=self.status,
+            queue_ms=ms('received','dequeued'), render_ms=ms('render','rendered'),
+            print_ms=ms('spool','done'), total_ms=ms('received','done'))
+
+    def elapsed(self, start, end):
+        """Seconds between two stages, or None if it didn't get there"""
+        try:
+            return self.times[end] - self.times[start]
+        except KeyError:
+            return None
+
+def make_text_layout(ctx, text, fontsize, font="Sans"):
+    with tracing.span("make_text_layout", fontsize=fontsize, chars=len(text)):
+        layout = PangoCairo.create_layout(ctx)
+        layout.set_alignment(Pango.Alignment.CENTER)
+        layout.set_font_description(Pango.FontDescription("%s %.2f" % (font, fontsize)))
+        #layout.set_width(int(width*Pango.SCALE))
+        layout.set_width(-1)
+        layout.set_text(text,-1)
+        layout.set_spacing(-0.2*SCALE*fontsize)
+        # This constant is font dependent. Oh well.
+        return layout
+
+class TextFitter:
+    """Choose font sizes from memoized Pango metrics.
+
+    Text size scales linearly with the font size, so each line of text
+    is laid out once, at INIT_FONTSIZE, and its width is remembered.
+    Line height comes from the font's ascent and descent, which are
+    looked up once per font. Only the final drawing needs a real layout.
+    """
+    SPACING = -0.2 # line spacing, relative to the font size; see make_text_layout
+
+    def __init__(self, font="Sans"):
+        self.font = font
+        self._widths = LRUCache(max_entries=20000)
+        self._metrics = None
+        self._local = threading.local()
+
+    @property
+    def context(self):
+        # Pango contexts must not be shared between threads
+        ctx = getattr(self._local, 'context', None)
+        if ctx is None:
+            ctx = PangoCairo.FontMap.get_default().create_context()
+            self._local.context = ctx
+        return ctx
+
+    def _font(self, fontsize):
+        return Pango.FontDescription("%s %d" % (self.font, fontsize))
+
+    def line_width(self, line):
+        """Width of a single line at INIT_FONTSIZE, in pixels"""
+        w = self._widths.get(line)
+        if w is None:
+            layout = Pango.Layout.new(self.context)
+            layout.set_font_description(self._font(INIT_FONTSIZE))
+            layout.set_text(line, -1)
+            w = layout.get_extents()[1].width / SCALE
+            self._widths.put(line, w)
+        return w
+
+    def line_height(self, fontsize):
+        """Height of one line (ascent plus descent) in pixels"""
+        if self._metrics is None:
+            m = self.context.get_metrics(self._font(INIT_FONTSIZE), None)
+            self._metrics = (m.get_ascent()+m.get_descent()) / SCALE
+        return self._metrics * fontsize / INIT_FONTSIZE
+
+    def width(self, text, fontsize):
+        """Width of (possibly multi-line) @text in pixels"""
+        w = max(self.line_width(line) for line in text.split('\n'))
+        return w * fontsize / INIT_FONTSIZE
+
+    def height(self, text, fontsize):
+        """Height of @text in pixels, from the top of the first line
+        to the bottom of the descenders of the last"""
+        n = text.count('\n')
+        return (n+1)*self.line_height(fontsize) + n*self.SPACING*fontsize
+
+    def fit(self, text, width, fill=0.95):
+        """The font size which makes @text @fill times as wide as @width"""
+        w = self.width(text, INIT_FONTSIZE)
+        if w <= 0:
+            return INIT_FONTSIZE
+        return int(INIT_FONTSIZE * width / w * fill)
+
+    def shrink(self, text, fontsize, width, height):
+        """Reduce @fontsize until @text fits into @width x @height"""
+        w = self.width(text, fontsize)
+        h = self.height(text, fontsize)
+        sf = min(width/w if w else 1, height/h if h else 1)
+        if sf < 1:
+            fontsize *= sf
+        return fontsize
+
+    def measure(self, text, width):
+        """Return height in pixels and font size of @text fitted to @width"""
+        fs = self.fit(text, width)
+        return self.height(text, fs), fs
+
+class Block:
+    """One part of a label, laid out on its own.
+
+    A block is only laid out again when it is dirty and what it shows
+    (its key) has changed; blocks that look the same are shared through
+    block_cache. The content is a recording in pixels with the origin at
+    the block's top left corner, @width pixels wide (the label's width)
+    and @height pixels high. @value is whatever else a later block needs.
+    """
+    dirty = True
+    key = None
+    content = None
+    height = 0
+    value = None
+
+    def make_key(self, prn):
+        raise NotImplementedError
+
+    def draw(self, prn, ctx):
+        """Draw the block; return its height and value"""
+        raise NotImplementedError
+
+    def size(self, prn):
+        return 1024
+
+    def update(self, prn):
+        """Lay out the block if needed. Returns True if it changed."""
+        if not self.dirty:
+            return False
+        self.dirty = False
+        key = (type(self).__name__, prn.res) + self.make_key(prn)
+        if key == self.key:
+            return False
+        self.key = key
+        res = block_cache.get(key)
+        if res is None:
+            content = cairo.RecordingSurface(cairo.Content.COLOR_ALPHA, None)
+            ctx = cairo.Context(content)
+            ctx.set_antialias(cairo.ANTIALIAS_NONE)
+            height, value = self.draw(prn, ctx)
+            del ctx
+            res = (content, height, value)
+            block_cache.put(key, res, self.size(prn))
+        self.content, self.height, self.value = res
+        return True
+
+    def paint(self, ctx, y):
+        """Replay the block at @y pixels from the top"""
+        if not self.height:
+            return
+        ctx.save()
+        ctx.set_source_surface(self.content, 0, y)
+        ctx.paint()
+        ctx.restore()
+
+class ImageBlock(Block):
+    """A picture above the text, as large as fits into the label's width
+    and IMAGE_H. Its value is its width in pixels."""
+    def make_key(self, prn):
+        return (prn.image and prn.image.digest,) + prn.image_size()
+
+    def size(self, prn):
+        w, h = prn.image_size()
+        return 1024 + 4*w*h
+
+    def draw(self, prn, ctx):
+        w, h = prn.image_size()
+        if not w:
+            return 0, 0
+        ctx.set_source_surface(get_image(prn.image, w, h), int((prn.width_px - w)/2), 0)
+        ctx.paint()
+        return h, w
+
+class TextBlock(Block):
+    """The main text, as large as it fits (or as the template says).
+    Its value is the font size."""
+    def make_key(self, prn):
+        layout = prn.template_layout()
+        return (prn.text, prn.width_px, prn.fitter.font, layout and layout[:2])
+
+    def size(self, prn):
+        return 1024 + 200*len(prn.text)
+
+    def draw(self, prn, ctx):
+        if not prn.text:
+            return 0, 0
+        layout = prn.template_layout()
+        if layout is not None:
+            fs, h, _ = layout
+        else:
+            h, fs = prn.fitter.measure(prn.text, prn.width_px)
+        layout = make_text_layout(ctx, prn.text, fs, prn.fitter.font)
+        w,_ = layout.get_pixel_size()
+        ctx.move_to(prn.width_px/2 - w/2, 0)
+        ctx.set_source_rgb(0, 0, 0)
+        PangoCairo.show_layout(ctx, layout)
+        return h, fs
+
+class BarcodeBlock(Block):
+    """The barcode's bars. Its value is their width in pixels.
+
+    Bars are whole pixels wide and start on a whole pixel, so at the
+    printer's resolution every bar edge is on a dot boundary.
+    """
+    def make_key(self, prn):
+        return (prn.barcode, prn.width_px, prn.res*prn.MIN_MODULE, int(prn.res*prn.BAR_H))
+
+    def draw(self, prn, ctx):
+        if not prn.barcode:
+            return 0, 0
+        bars, bw = get_bars(prn.barcode, prn.width_px, prn.res*prn.MIN_MODULE)
+        if bars is None:
+            return 0, 0
+        ctx.translate(int((prn.width_px - bw)/2), 0)
+        ctx.scale(1, int(prn.res*prn.BAR_H))
+        ctx.set_source_surface(bars, 0, 0)
+        ctx.paint()
+        return prn.res*prn.BAR_H, bw
+
+class CaptionBlock(Block):
+    """The barcode in text, to go over the bottom of the bars.
+
+    The text is at most as large as the main text (@fs), may cover 1/3rd
+    of the barcode height, and must be somewhat narrower than the barcode
+    (@bw pixels).
+    """
+    fs = 0
+    bw = 0
+
+    def make_key(self, prn):
+        layout = prn.template_layout()
+        return (prn.barcode, self.fs, self.bw, prn.res*prn.BAR_H, prn.width_px, prn.fitter.font,
+            layout and layout[2])
+
+    def size(self, prn):
+        return 1024 + 100*len(prn.barcode)
+
+    def draw(self, prn, ctx):
+        if not self.bw:
+            return 0, 0
+        layout = prn.template_layout()
+        if layout is not None:
+            bfs = layout[2]
+        else:
+            bfs = prn.fitter.shrink(prn.barcode, self.fs, self.bw/1.2, prn.res*prn.BAR_H/3)
+        layout = make_text_layout(ctx, prn.barcode, bfs, prn.fitter.font)
+        lw,lh = layout.get_pixel_size()
+
+        ctx.set_source_rgb(1, 1, 1)
+        ctx.rectangle(prn.width_px/2 - lw/2 - lh/6, 0, lw+lh/3, lh+1)
+        ctx.fill()
+
+        ctx.set_source_rgb(0, 0, 0)
+        ctx.move_to(prn.width_px/2 - lw/2, 0)
+        PangoCairo.show_layout(ctx, layout)
+        return lh, bfs
+
 class LabelPrinter:
     PAGE_WIDTH=38
     LEFT_MARGIN=1
     RIGHT_MARGIN=1
     TOP_MARGIN=2
     BOTTOM_MARGIN=1
+    MIN_MODULE=0.1 # mm, narrowest barcode bar we still print
 
     selected_printer = None
     print_settings = None
 
     barcode = ""
     text = ""
+    template = None # templates.Template; None: fit each label
+    image = None # Asset
+    asset_dir = "." # where images named by records are
+    templates = {} # by name, for records to choose from
     _need_reflow = False
     height = 999
     content = None # RecordingSurface
     font_size = 0
-
-    def __init__(self, ui, printer=None):
+    pages = () # (content, height) of the labels being printed
+    jobs = () # Jobs being printed
+    raw = None # raster.Sink; print there instead of via Gtk
+    dpi = None # the printer's resolution, if known; labels are laid out for it
+    auto_dpi = True # take dpi from the print settings
+    fitter = None # TextFitter
+    ahead = None # RenderAhead
+
+    def __init__(self, ui, printer=None, fitter=None, settings=None):
+        """@settings override the print SETTINGS for this printer"""
         super().__init__()
         self.ui = ui
+        self.settings = dict(SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        self.fitter = fitter if fitter is not None else TextFitter()
+        self.image_block = ImageBlock()
+        self.text_block = TextBlock()
+        self.bar_block = BarcodeBlock()
+        self.caption_block = CaptionBlock()
         self.set_width(38.0)
-        self.selected_printer = printer
+        self.selected_printer = printer or None # "" means "not chosen" too
 
     @property
     def BAR_H(self):
         return self.PAGE_WIDTH/5
 
+    @property
+    def IMAGE_H(self):
+        return self.PAGE_WIDTH/4
+
+    @property
+    def blocks(self):
+        return (self.image_block, self.text_block, self.bar_block, self.caption_block)
+
     def set_width(self,width):
         self.PAGE_WIDTH = width
-        self.setup_page()
+        for block in self.blocks:
+            block.dirty = True
+        self._need_reflow = True
+
+    def set_dpi(self, dpi):
+        """Lay labels out for a printer with @dpi dots per inch"""
+        if dpi == self.dpi:
+            return
+        self.dpi = dpi
+        for block in self.blocks:
+            block.dirty = True
         self._need_reflow = True
 
+    @property
+    def res(self):
+        """Pixels per mm of the layout"""
+        return self.dpi/25.4 if self.dpi else RES
+
+    def to_pt(self, fs):
+        """Font size @fs at our resolution, in the units the editor shows
+        (and templates use)"""
+        return fs * RES/self.res
+
+    def from_pt(self, fs):
+        return fs * self.res/RES
+
     @property
     def width_px(self):
-        return int(RES * (self.PAGE_WIDTH-self.LEFT_MARGIN-self.RIGHT_MARGIN) + 0.9999)
+        return int(self.res * (self.PAGE_WIDTH-self.LEFT_MARGIN-self.RIGHT_MARGIN) + 0.9999)
 
     @property
     def height_px(self):
-        return int(RES * self.height + 0.9999)
+        return int(self.res * self.height + 0.9999)
 
     def set_barcode(self, barcode):
         self.barcode = barcode
+        self.bar_block.dirty = True
+        self.caption_block.dirty = True
         self._need_reflow = True
 
     def set_text(self, text):
         self.text = text
+        self.text_block.dirty = True
         self._need_reflow = True
 
-    def get_page_setup(self):
-        paper = Gtk.PaperSize.new_custom("Endless","Endless", self.PAGE_WIDTH, self.height+self.TOP_MARGIN+self.BOTTOM_MARGIN, Gtk.Unit.MM)
+    def set_image(self, ref):
+        """Show the image @ref (see load_asset) above the text, or none"""
+        self.set_asset(self.asset_for(ref))
+
+    def set_asset(self, image):
+        if image is self.image:
+            return
+        self.image = image
+        self.image_block.dirty = True
+        self._need_reflow = True
+
+    def asset_for(self, ref):
+        if not ref:
+            return None
+        return load_asset(ref, self.asset_dir)
+
+    def record_asset(self, rec):
+        """The image of record @rec; Jobs have theirs loaded already"""
+        asset = getattr(rec, 'asset', None)
+        if asset is not None:
+            return asset
+        return self.asset_for(rec.get('image'))
+
+    def image_size(self, image=None):
+        """Size in pixels of the current image (or @image) on the label"""
+        if image is None:
+            image = self.image
+        if image is None:
+            return 0, 0
+        iw, ih = image.image.size
+        f = min(self.width_px/iw, self.res*self.IMAGE_H/ih)
+        return max(1, int(iw*f)), max(1, int(ih*f))
+
+    def set_template(self, template):
+        if template is self.template:
+            return
+        self.template = template
+        self.text_block.dirty = True
+        self.caption_block.dirty = True
+        self._need_reflow = True
+
+    def template_for(self, rec):
+        """The template record @rec asks for"""
+        name = rec.get('template')
+        if not name:
+            return None
+        try:
+            return self.templates[name]
+        except KeyError:
+            raise ValueError("Unknown template: %r" % (name,)) from None
+
+    def set_record(self, rec):
+        self.set_template(self.template_for(rec))
+        self.set_asset(self.record_asset(rec))
+        self.set_barcode(rec['barcode'])
+        self.set_text('\n'.join(rec['text']))
+
+    def template_layout(self, template=None):
+        """Font size, text height (pixels) and caption size that the
+        current template (or @template) has at our width.
+        None if there is no template."""
+        tpl = template or self.template
+        if tpl is None:
+            return None
+        key = (self.res, self.width_px, int(self.res*self.BAR_H), self.fitter.font)
+        res = tpl.compiled.get(key)
+        if res is None:
+            sample = tpl.sample
+            fs = tpl.font_size
+            if fs is None:
+                fs = self.fitter.fit('\n'.join(sample['text']), self.width_px)
+            else:
+                fs = self.from_pt(fs)
+            h = self.fitter.height('\n'*(tpl.lines-1), fs)
+            cfs = tpl.caption_size
+            if cfs is None:
+                code = ""
+                bw = self.width_px
+                if sample and sample['barcode']:
+                    code = sample['barcode']
+                    bw = get_bars(code, self.width_px, self.res*self.MIN_MODULE)[1] or bw
+                # with no sample barcode this only depends on the height
+                cfs = self.fitter.shrink(code, fs, bw/1.2, self.res*self.BAR_H/3)
+            else:
+                cfs = self.from_pt(cfs)
+            res = tpl.compiled[key] = (fs, h, cfs)
+        return res
+
+    def update_blocks(self):
+        """Lay out the blocks that changed"""
+        image, text, bars, caption = self.blocks
+        image.update(self)
+        changed = text.update(self)
+        changed = bars.update(self) or changed
+        if changed:
+            caption.dirty = True
+        caption.fs = text.value if self.text else self.from_pt(2*INIT_FONTSIZE)
+        caption.bw = bars.value
+        caption.update(self)
+
+    def page_size(self):
+        """Size of the whole label in mm, including the margins"""
+        return self.PAGE_WIDTH, self.height+self.TOP_MARGIN+self.BOTTOM_MARGIN
+
+    def get_paper_size(self, height=None):
+        if height is None:
+            height = self.height
+        return Gtk.PaperSize.new_custom("Endless","Endless", self.PAGE_WIDTH, height+self.TOP_MARGIN+self.BOTTOM_MARGIN, Gtk.Unit.MM)
+
+    def get_page_setup(self, height=None):
         setup = Gtk.PageSetup()
-        setup.set_paper_size(paper)
+        setup.set_paper_size(self.get_paper_size(height))
         setup.set_bottom_margin(self.BOTTOM_MARGIN, Gtk.Unit.MM)
         setup.set_left_margin(self.LEFT_MARGIN, Gtk.Unit.MM)
         setup.set_right_margin(self.RIGHT_MARGIN, Gtk.Unit.MM)
         setup.set_top_margin(self.TOP_MARGIN, Gtk.Unit.MM)
         return setup
 
+    def new_settings(self):
+        settings = Gtk.PrintSettings()
+        for a,b in self.settings.items():
+            settings.set(a,b)
+        if self.selected_printer is not None:
+            settings.set_printer(self.selected_printer)
+        return settings
+
+    def load_settings(self):
+        """Use the settings of an earlier run if they are for our printer"""
+        if not os.path.exists(SETTINGS_FILE):
+            return
+        try:
+            settings = Gtk.PrintSettings.new_from_file(SETTINGS_FILE)
+        except GLib.Error:
+            return
+        printer = settings.get_printer()
+        if not printer or self.selected_printer not in (None, printer):
+            return
+        self.print_settings = settings
+        self.selected_printer = printer
+        print("Using the print settings of the last run, for %s" % (printer,), file=sys.stderr)
+
+    def save_settings(self):
+        try:
+            os.makedirs(os.path.dirname(SETTINGS_FILE), exist_ok=True)
+            self.print_settings.to_file(SETTINGS_FILE)
+        except (OSError, GLib.Error) as exc:
+            print("Could not save print settings:", exc, file=sys.stderr)
+
     def setup_page(self, force=False):
-        setup = self.get_page_setup()
+        """Find the printer, unless we know it already.
+        With @force, ask the user."""
+        if not force and self.print_settings is None:
+            self.load_settings()
         if force or self.selected_printer is None:
-            settings = Gtk.PrintSettings()
-            for a,b in SETTINGS.items():
-                settings.set(a,b)
-            if self.selected_printer is not None:
-                settings.set_printer(self.selected_printer)
+            settings = self.new_settings()
+            setup = self.get_page_setup()
             # show print dialog
             op = Gtk.PrintOperation()
             op.set_unit(Gtk.Unit.MM)
@@ -195,146 +948,283 @@ class LabelPrinter:
 
             if res != Gtk.PrintOperationResult.CANCEL or self.selected_printer is None:
                 raise RuntimeError("You need to click 'Print'.")
+            self.save_settings()
+        elif self.print_settings is None:
+            self.print_settings = self.new_settings()
+
+        if self.auto_dpi:
+            dpi = self.settings_dpi()
+            if dpi:
+                self.set_dpi(dpi)
+
+    def settings_dpi(self):
+        """The printer resolution in our print settings, if there is one"""
+        settings = self.print_settings
+        if settings.has_key('resolution'):
+            return settings.get_resolution()
+        m = re.match(r'(\d+)', settings.get('cups-Resolution') or '')
+        return int(m.group(1)) if m else None
 
         # PrintOperation
+    def clone(self):
+        """A copy with the same page geometry but no printer or UI,
+        for rendering on another thread"""
+        prn = LabelPrinter(None, fitter=self.fitter, settings=self.settings)
+        prn.LEFT_MARGIN = self.LEFT_MARGIN
+        prn.RIGHT_MARGIN = self.RIGHT_MARGIN
+        prn.TOP_MARGIN = self.TOP_MARGIN
+        prn.BOTTOM_MARGIN = self.BOTTOM_MARGIN
+        prn.set_width(self.PAGE_WIDTH)
+        prn.set_dpi(self.dpi)
+        return prn
+
+    def label_key(self, barcode=None, text=None):
+        """Everything that affects what a label looks like.
+        Defaults to the current barcode and text."""
+        if barcode is None:
+            barcode = self.barcode
+        if text is None:
+            text = self.text
+        return self._key(barcode, text, self.template, self.image)
+
+    def record_key(self, rec):
+        """label_key() of record @rec"""
+        return self._key(rec['barcode'], '\n'.join(rec['text']), self.template_for(rec),
+            self.record_asset(rec))
+
+    def _key(self, barcode, text, template, image=None):
+        return (barcode, text, self.PAGE_WIDTH,
+            self.LEFT_MARGIN, self.RIGHT_MARGIN, self.TOP_MARGIN, self.BOTTOM_MARGIN,
+            self.fitter.font, template and template.name, image and image.digest, self.res)
+
     def reflow(self):
         if not self._need_reflow:
             return False
-
-        self.content = cairo.RecordingSurface(cairo.Content.COLOR,None)
-        self.content.set_fallback_resolution(RES_I,RES_I)
-        ctx = cairo.Context(self.content)
-        ctx.set_antialias(cairo.ANTIALIAS_NONE)
-        self.gen_page(ctx)
+        self._need_reflow = False
+
+        key = self.label_key()
+        res = label_cache.get(key)
+        if res is None and self.ahead is not None:
+            res = self.ahead.wait(key)
+        if res is None:
+            content = cairo.RecordingSurface(cairo.Content.COLOR,None)
+            dpi = self.dpi or RES_I
+            content.set_fallback_resolution(dpi, dpi)
+            ctx = cairo.Context(content)
+            ctx.set_antialias(cairo.ANTIALIAS_NONE)
+            t = time.monotonic()
+            self.gen_page(ctx)
+            render_time.observe(time.monotonic()-t)
+            del ctx
+            res = (content, self.height, self.font_size)
+            label_cache.put(key, res, 2048 + 200*len(self.text) + 100*len(self.barcode))
+        self.content, self.height, self.font_size = res
         return True
 
-    def gen_page(self, ctx):
-        if self.barcode:
-            bars = pybars.get(get_code(self.barcode), self.barcode, writer=ImageWriter())
-            bars = bars.render(writer_options=dict(format="PNG", write_text=False))
-            if bars.width > self.width_px:
-                bars = None
+    def measure(self, barcode=None, text=None, template=None, image=None):
+        """Return the height (mm) and font size of a label without drawing
+        it. Defaults to the current barcode and text, and no template
+        or image."""
+        if barcode is None:
+            barcode = self.barcode
+        if text is None:
+            text = self.text
+        res = self.res
+        top = self.TOP_MARGIN
+        if image is not None:
+            top += self.image_size(image)[1]/res + 0.3
+
+        if text:
+            layout = template and self.template_layout(template)
+            if layout is not None:
+                fs, h, _ = layout
             else:
-                bars = pil2cairo(bars)
+                h, fs = self.fitter.measure(text, self.width_px)
+            h /= res # mm
+            h += 0.3 # space between label and barcode
         else:
-            bars = None
+            h = 0
+            fs = 0
+        h += top
+        if barcode and get_bars(barcode, self.width_px, res*self.MIN_MODULE)[0] is not None:
+            h += self.BAR_H
+        return h+self.TOP_MARGIN, self.to_pt(fs)
+
+    def gen_page(self, ctx):
+        self.update_blocks()
+        image, text, bars, caption = self.blocks
+        res = self.res
 
         # start with a white background
         # otherwise things get interesting
         ctx.set_source_rgb(1, 1, 1)
-        ctx.rectangle(0,0, self.width_px,999*RES)
+        ctx.rectangle(0,0, self.width_px,999*res)
         ctx.fill()
-        
-        def make_text_layout(text, fontsize):
-            layout = PangoCairo.create_layout(ctx)
-            layout.set_alignment(Pango.Alignment.CENTER)
-            layout.set_font_description(Pango.FontDescription("Sans %d" % fontsize))
-            #layout.set_width(int(width*Pango.SCALE))
-            layout.set_width(-1)
-            layout.set_text(text,-1)
-            layout.set_spacing(-0.2*SCALE*fontsize)
-            # This constant is font dependent. Oh well.
-            return layout
-
-        if self.text:
-            layout = make_text_layout(self.text, INIT_FONTSIZE)
-            w,h = layout.get_pixel_size()
-            fs = int(INIT_FONTSIZE * self.width_px / w * 0.95)
-            layout = make_text_layout(self.text, fs)
-            self.font_size = fs
-            w,h = layout.get_pixel_size()
-            ctx.move_to(self.width_px/2 - w/2, self.TOP_MARGIN*RES)
-            ctx.set_source_rgb(0, 0, 0)
-            PangoCairo.show_layout(ctx, layout)
-
-            layout = make_text_layout(self.text+'q', fs)
-            ex = layout.get_extents()
-            bot = (ex[0].y+ex[0].height) / SCALE
-            h = bot
-
-            if False:
-                ctx.save()
-                ctx.set_source_rgb(255, 0, 0)
-                ctx.rectangle(self.width_px/2 - w/2, self.TOP_MARGIN*RES, w, h)
-                ctx.set_line_width(2)
-                ctx.stroke()
-                ctx.restore()
-
-            h /= RES # mm
+
+        top = self.TOP_MARGIN
+        if image.height:
+            image.paint(ctx, int(top*res))
+            top += image.height/res + 0.3
+
+        text.paint(ctx, top*res)
+        if text.height:
+            self.font_size = self.to_pt(text.value)
+            h = text.height/res # mm
             h += 0.3 # space between label and barcode
         else:
             h = 0
             self.font_size = 0
-            fs = 2*INIT_FONTSIZE
-        h += self.TOP_MARGIN
+        h += top
 
-        if bars is not None:
-            s = int(self.width_px / bars.get_width())
-            bw = bars.get_width() * s
+        if bars.height:
+            bars.paint(ctx, int(h*res))
+            h += self.BAR_H
+            caption.paint(ctx, h*res - caption.height)
 
-            ctx.save()
-            ctx.scale(s,s)
-            ctx.set_source_surface(bars, (RES*self.PAGE_WIDTH/2 - bw/2 - RES*self.LEFT_MARGIN)/s, h*RES/s-bars.get_height()/5)
-            ctx.set_antialias(cairo.ANTIALIAS_NONE)
-            #ctx.set_operator(cairo.OPERATOR_DARKEN)
-            ctx.rectangle(int((self.width_px/2 - bw/2)/s), int(h*RES/s), int(bw/s), int(RES*self.BAR_H/s))
-            ctx.fill()
-            ctx.restore()
-
-            if False:
-                ctx.save()
-                ctx.set_source_rgb(255, 0, 0)
-                ctx.rectangle(int((self.width_px/2 - bw/2)), int(h*RES), int(bw), int(RES*self.BAR_H))
-                ctx.stroke()
-                ctx.restore()
+        self.height = h +self.TOP_MARGIN #+self.BOTTOM_MARGIN
 
-            h += self.BAR_H
+    def copies(self, copies=1):
+        """The number of copies to print @copies labels"""
+        return copies * int(self.settings['n-copies'])
 
-            # add text to the label.
-            # The text is at most as large as the main text,
-            # may cover 1/3rd of the barcode height,
-            # and must be somewhat narrower than the barcode
-            bfs = fs
-            layout = make_text_layout(self.barcode, bfs)
-            lw,lh = layout.get_pixel_size()
-            sfh = RES*self.BAR_H/3/lh
-            sfw = bw/1.2/lw
-            sf = min(sfw,sfh)
-            if sf < 1:
-                bfs *= sf
-                layout = make_text_layout(self.barcode, bfs)
-                lw,lh = layout.get_pixel_size()
-
-            ctx.set_source_rgb(1, 1, 1)
-            ctx.rectangle(self.width_px/2 - lw/2 - lh/6, h*RES-lh, lw+lh/3, lh+1)
-            ctx.fill()
-
-            ctx.set_source_rgb(0, 0, 0)
-            ctx.move_to(self.width_px/2 - lw/2, h*RES-lh)
-            PangoCairo.show_layout(ctx, layout)
+    def print(self, preview=False, data=None, jobs=(), copies=1):
+        """Print the current label, or each of the records in @data as
+        one page of a single print job. Everything is printed @copies
+        times (on top of n-copies).
 
-        self.height = h +self.TOP_MARGIN #+self.BOTTOM_MARGIN
+        @jobs are the Jobs the current label belongs to; those in @data
+        are found automatically.
+        """
+        if data is not None:
+            jobs = [d for d in data if isinstance(d, Job)]
+        self.jobs = list(jobs)
 
-    def print(self, preview=False):
+        if self.raw is not None and not preview:
+            self.print_raw(data, copies)
+            return
         self.setup_page()
 
-        setup = self.get_page_setup()
+        if data is None:
+            self.reflow()
+            self.pages = [(self.content, self.height)]
+        else:
+            self.pages = [(self.content, self.height) for _ in render_labels(self, data)]
+
+        setup = self.get_page_setup(self.pages[0][1])
         op = Gtk.PrintOperation()
         op.set_allow_async(True)
         op.set_default_page_setup(setup)
 
-        op.set_print_settings(self.print_settings)
+        settings = self.print_settings
+        if copies != 1:
+            settings = settings.copy()
+            settings.set_n_copies(settings.get_n_copies() * copies)
+        op.set_print_settings(settings)
         #op.set_default_page_setup(self.page_setup)
         op.set_unit(Gtk.Unit.MM)
         op.connect("begin_print", self.begin_print)
+        op.connect("request_page_setup", self.request_page_setup)
         op.connect("draw_page", self.draw_page)
         op.connect("done", self.done_printing)
 
-        res = op.run(Gtk.PrintOperationAction.PREVIEW if preview else Gtk.PrintOperationAction.PRINT)
+        for job in self.jobs:
+            job.stamp('spool')
+        with tracing.span("PrintOperation.run", jobs=[job.id for job in self.jobs], pages=len(self.pages)) as sp:
+            res = op.run(Gtk.PrintOperationAction.PREVIEW if preview else Gtk.PrintOperationAction.PRINT)
+            sp.set(result=res)
         print("PR",res)
     
-    def done_printing(self, *a):
-        print("DONE PRINT",a)
+    def print_raw(self, data=None, copies=1):
+        """Send the current label, or the records in @data, to the raw
+        printer. Neither Gtk nor CUPS is involved."""
+        status = self._spool_raw(data, copies)
+        # this runs from a print request, don't re-enter it
+        GObject.idle_add(self.finish, status)
+
+    def _spool_raw(self, data, copies=1):
+        for job in self.jobs:
+            job.stamp('spool')
+        copies = self.copies(copies)
+        try:
+            with tracing.span("raw print", jobs=[job.id for job in self.jobs], copies=copies):
+                if data is None:
+                    self.reflow()
+                    self.raw.write(self.rasterize(copies=copies))
+                else:
+                    for _ in render_labels(self, data):
+                        self.raw.write(self.rasterize(copies=copies))
+        except Exception as exc:
+            print("RAW PRINT", repr(exc), file=sys.stderr)
+            return "failed"
+        return "ok"
+
+    def lp_command(self, copies=1):
+        """The lp command line for printing a PDF from stdin"""
+        cmd = ['lp', '-s']
+        printer = self.selected_printer or self.settings.get('printer')
+        if printer:
+            cmd += ['-d', printer]
+        for k,v in self.settings.items():
+            if k == 'n-copies':
+                cmd += ['-n', str(self.copies(copies))]
+            elif k.startswith('cups-') and v:
+                cmd += ['-o', '%s=%s' % (k[5:], v)]
+        cmd.append('-')
+        return cmd
+
+    def spool(self, data, copies=1):
+        """Print the records in @data as one job, without Gtk: to the raw
+        printer if there is one, else as a PDF with one page per label
+        through CUPS' lp. Returns the job's status.
+
+        With @copies, @data are that many identical records, printed as
+        copies of the first.
+
+        Unlike print(), this blocks until the job has been handed off, and
+        calls finish() itself.
+        """
+        self.jobs = [d for d in data if isinstance(d, Job)]
+        if copies > 1:
+            data = data[:1]
+        if self.raw is not None:
+            status = self._spool_raw(data, copies)
+        else:
+            buf = io.BytesIO()
+            render_pdf(self, data, buf)
+            for job in self.jobs:
+                job.stamp('spool')
+            try:
+                with tracing.span("lp", jobs=[job.id for job in self.jobs], bytes=buf.tell()):
+                    subprocess.run(self.lp_command(copies), input=buf.getvalue(), check=True,
+                        stdout=subprocess.DEVNULL)
+            except (OSError, subprocess.CalledProcessError) as exc:
+                print("LP", repr(exc), file=sys.stderr)
+                status = "failed"
+            else:
+                status = "ok"
+        self.finish(status)
+        return status
+
+    def done_printing(self, op=None, result=None):
+        print("DONE PRINT",op,result)
+        if result == Gtk.PrintOperationResult.ERROR:
+            status = "failed"
+        elif result == Gtk.PrintOperationResult.CANCEL:
+            status = "cancelled"
+        else:
+            status = "ok"
+        with tracing.span("done_printing", jobs=[job.id for job in self.jobs], status=status):
+            self.finish(status)
+
+    def finish(self, status):
+        """The current print job is done"""
+        jobs, self.jobs = self.jobs, []
+        for job in jobs:
+            job.set_done(status)
+            jobs_finished.inc(status=status)
+            if 'spool' in job.times:
+                spool_time.observe(job.elapsed('spool','done'))
+            total_time.observe(job.elapsed('received','done'))
         if self.ui is not None:
             self.ui.check_print_job()
 
@@ -345,36 +1235,248 @@ class LabelPrinter:
         self.height, self.font_size = self.compute_heigth_fontsize(width, size_hint)
 
     def begin_print(self, operation, context):
-        operation.set_n_pages(1) # len(page_breaks) + 1)
+        operation.set_n_pages(len(self.pages))
+
+    def request_page_setup(self, operation, context, page_number, setup):
+        # each label is as long as it needs to be
+        setup.set_paper_size(self.get_paper_size(self.pages[page_number][1]))
 
     def draw_nothing (self, operation, context, page_number):
         pass
 
     def draw_page (self, operation, context, page_number):
         #self.draw_image(context.get_cairo_context())
-        self.draw_direct_image(context.get_cairo_context())
+        self.draw_direct_image(context.get_cairo_context(), self.pages[page_number][0])
 
-    def draw_direct_image(self, ctx):
+    def draw_direct_image(self, ctx, content=None):
         #ctx.translate(self.LEFT_MARGIN,self.TOP_MARGIN)
-        p = 1/RES
+        if content is None:
+            self.reflow()
+            content = self.content
+        p = 1/self.res
         ctx.scale(p,p)
-        self.gen_page(ctx)
+        # replay the label instead of laying it out again
+        ctx.set_source_surface(content, 0, 0)
+        ctx.set_antialias(cairo.ANTIALIAS_NONE)
+        ctx.paint()
 
     def draw_image(self, ctx):
         #ctx.rectangle(self.LEFT_MARGIN,self.TOP_MARGIN,self.PAGE_WIDTH-self.LEFT_MARGIN-self.RIGHT_MARGIN,self.height-self.TOP_MARGIN-self.BOTTOM_MARGIN)
         ctx.rectangle(0, 0, self.PAGE_WIDTH,self.height)
-        p = 1/RES
+        p = 1/self.res
         ctx.scale(p,p)
         ctx.set_source_surface(self.content, self.LEFT_MARGIN/p, self.TOP_MARGIN/p)
         ctx.set_antialias(cairo.ANTIALIAS_NONE)
         ctx.fill()
 
+    def get_image(self, dpi):
+        """Render the current label, margins included, to an image.
+
+        At the resolution the label was laid out for, the label is
+        placed on whole pixels, so that it is not resampled at all."""
+        scale = dpi/25.4
+        w,h = self.page_size()
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, int(w*scale+0.9999), int(h*scale+0.9999))
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(1,1,1)
+        ctx.paint()
+        ctx.translate(round(self.LEFT_MARGIN*scale), round(self.TOP_MARGIN*scale))
+        p = scale/self.res
+        ctx.scale(p,p)
+        ctx.set_source_surface(self.content, 0, 0)
+        ctx.set_antialias(cairo.ANTIALIAS_NONE)
+        ctx.paint()
+        surface.flush()
+        return surface
+
+    def rasterize(self, dpi=None, copies=None):
+        """Return the current label as a 1-bit raster frame, by default
+        at the printer's resolution"""
+        if dpi is None:
+            dpi = self.dpi or RAW_DPI
+        if copies is None:
+            copies = int(self.settings['n-copies'])
+        bpl = int(self.settings['cups-BytesPerLine'])
+        align = self.settings['cups-Align'].lower()
+        key = (self.label_key(), dpi, bpl, align)
+        res = raster_cache.get(key)
+        if res is None:
+            surface = self.get_image(dpi)
+            w = surface.get_width()
+            h = surface.get_height()
+            bpl, data = raster.pack(surface.get_data(), w, h, surface.get_stride(), bpl, align)
+            surface.finish()
+            res = (w, h, bpl, data)
+            raster_cache.put(key, res, 256 + len(data))
+        w, h, bpl, data = res
+        return raster.frame(w, h, bpl, data, dpi, copies)
+
+    def paint_content(self, ctx):
+        """Replay the current label onto @ctx, which must be in mm
+        with its origin at the paper's top left corner"""
+        ctx.save()
+        ctx.translate(self.LEFT_MARGIN, self.TOP_MARGIN)
+        p = 1/self.res
+        ctx.scale(p,p)
+        ctx.set_source_surface(self.content, 0, 0)
+        ctx.set_antialias(cairo.ANTIALIAS_NONE)
+        ctx.paint()
+        ctx.restore()
+
+def render_labels(prn, data):
+    """Lay out each record in turn; yields the page size in mm"""
+    for rec in data:
+        if isinstance(rec, Job):
+            rec.stamp('render')
+        prn.set_record(rec)
+        prn.reflow()
+        if isinstance(rec, Job):
+            rec.stamp('rendered')
+        yield prn.page_size()
+
+def render_pdf(prn, data, out):
+    """Write one PDF page per record, each as long as its label.
+    Pages are written as soon as their record has been read."""
+    surface = cairo.PDFSurface(out, prn.PAGE_WIDTH*PT, prn.PAGE_WIDTH*PT)
+    n = 0
+    for w,h in render_labels(prn, data):
+        surface.set_size(w*PT, h*PT)
+        ctx = cairo.Context(surface)
+        ctx.scale(PT,PT)
+        prn.paint_content(ctx)
+        ctx.show_page()
+        n += 1
+    surface.finish()
+    return n
+
+def render_png(prn, data, pattern, dpi):
+    """Write one PNG file per record. @pattern contains a %d for the
+    record number."""
+    n = 0
+    for _ in render_labels(prn, data):
+        n += 1
+        surface = prn.get_image(dpi)
+        surface.write_to_png(pattern % (n,))
+        surface.finish()
+    return n
+
+def render_raw(prn, data, dest, dpi):
+    """Send one raster frame per record to @dest"""
+    sink = raster.Sink(dest)
+    n = 0
+    try:
+        for _ in render_labels(prn, data):
+            sink.write(prn.rasterize(dpi))
+            n += 1
+    finally:
+        sink.close()
+    return n
+
+class RenderAhead:
+    """Lay out queued labels on worker threads while the printer is busy.
+
+    Finished labels go to label_cache, so printing them is a mere replay.
+    A label that is still being rendered when it's needed is waited for.
+    Each worker thread lays out labels on a printer-less clone of its own.
+    """
+    def __init__(self, prn, depth=4, workers=2):
+        self.prn = prn
+        self.depth = depth
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="render")
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def feed(self, data):
+        """Start rendering the first few records of the queue @data"""
+        geometry = self.geometry()
+        for rec in data.peek(self.depth):
+            try:
+                key = self.prn.record_key(rec)
+            except (ValueError, OSError):
+                continue # printing it will fail
+            with self._lock:
+                if key in self._pending or key in label_cache:
+                    continue
+                f = self._pool.submit(self._render, geometry, key, rec)
+                self._pending[key] = f
+            f.add_done_callback(lambda _, key=key: self._done(key))
+
+    def geometry(self):
+        """What a clone takes over from the printer"""
+        prn = self.prn
+        return (prn.PAGE_WIDTH, prn.dpi, prn.LEFT_MARGIN, prn.RIGHT_MARGIN,
+            prn.TOP_MARGIN, prn.BOTTOM_MARGIN)
+
+    def _printer(self, geometry):
+        """This thread's clone, made again if the printer's geometry changed"""
+        local = self._local
+        if getattr(local, 'geometry', None) != geometry:
+            local.prn = self.prn.clone()
+            local.geometry = geometry
+        return local.prn
+
+    def _render(self, geometry, key, rec):
+        # runs in a worker thread
+        prn = self._printer(geometry)
+        prn.set_record(rec)
+        if prn.label_key() != key:
+            return None # the printer changed since; let it render this itself
+        prn.reflow()
+        return prn.content, prn.height, prn.font_size
+
+    def _done(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def wait(self, key):
+        """Return the label for @key if it is being rendered, else None"""
+        with self._lock:
+            f = self._pending.get(key)
+        if f is None:
+            return None
+        try:
+            return f.result()
+        except Exception:
+            return None # let the caller try again, and fail visibly
+
+    def stop(self):
+        self._pool.shutdown(wait=False)
+
+def take(queue, batch=1, coalesce=1):
+    """Take the next print job's worth of records from @queue.
+
+    Records identical to the first one (up to @coalesce in all) are
+    printed as copies of it. Returns the records, and the number of
+    copies: 1 if they are @batch different records for one job.
+    """
+    data = queue.get(1)
+    if data and coalesce > 1:
+        first = dict(data[0])
+        data += queue.get_while(lambda rec: dict(rec) == first, coalesce-1)
+        if len(data) > 1:
+            jobs_coalesced.inc(len(data)-1)
+            return data, len(data)
+    if data and batch > 1:
+        data += queue.get(batch-1)
+    return data, 1
+
+def mark_dequeued(data):
+    for job in data:
+        if isinstance(job, Job):
+            job.stamp('dequeued')
+            queue_wait.observe(job.elapsed('received','dequeued'))
+            tracing.interval("queued", job.id, job.times['received'], job.times['dequeued'],
+                priority=job.priority)
+
 APPNAME="labelprint"
 APPVERSION="0.1"
 
 class LabelUI(GObject.GObject):    
     data = None
     printing = False
+    batch = 1 # max number of queued labels to print as one job
+    coalesce = 1 # max number of identical queued labels to print as copies of one
 
     __gsignals__ = {
         'run_print': (GObject.SIGNAL_RUN_FIRST, None, (bool,))
@@ -391,35 +1493,107 @@ class LabelUI(GObject.GObject):
             return
         self.printing = True
 
-        if self.data:
-            data = self.data.pop(0)
-            self._print(data['barcode'],data['text'], preview)
-        else:
+        data, copies = take(self.data, self.batch, self.coalesce)
+        if not data:
             self.prn.print(preview)
+            return
+        self._dequeued(data)
+        try:
+            if copies > 1:
+                self._print(data[0], preview, data, copies)
+            elif len(data) > 1:
+                self._print_batch(data, preview)
+            else:
+                self._print(data[0], preview)
+        except Exception:
+            traceback.print_exc()
+            # don't leave the jobs hanging, and go on with the next
+            self.prn.jobs = [job for job in data if isinstance(job, Job)]
+            self.prn.finish("failed")
+
+    def _feed(self):
+        if self.prn.ahead is not None:
+            self.prn.ahead.feed(self.data)
+
+    def _dequeued(self, data):
+        mark_dequeued(data)
+        self._feed()
+
+    # the interface shared with Daemon; here the editor is the only printer
+    routes = ()
+    dpi = None # see PrinterWorker
+    raw_dest = None
+
+    @property
+    def workers(self):
+        return (self,)
+
+    def route(self, rec, key=None):
+        return self
+
+    def full(self):
+        return self.data.full()
 
-    def _print(self, barcode, text, preview):
+    def wait_space(self):
+        self.data.wait_space()
+
+    def queued(self):
+        return len(self.data)
+
+    def submit(self, data, key=None):
+        """Queue some labels. Called from the AMQP thread."""
+        self.data.put(data)
+        self._feed()
+
+    def _ready(self):
+        # called by the queue, once per burst of labels
+        GObject.idle_add(self.emit, "run_print", False) # emit the signal
+
+    def _print(self, data, preview, jobs=None, copies=1):
         """runs in GTK context"""
-        text = '\n'.join(text)
+        barcode = data['barcode']
+        text = '\n'.join(data['text'])
+        if jobs is None:
+            jobs = [data]
+        jobs = [job for job in jobs if isinstance(job, Job)]
         prn = self.prn
 
-        self['txt_code'].set_text(barcode)
-        prn.set_barcode(barcode)
+        self._show(barcode, text)
+        prn.set_record(data)
 
-        self['label_buf'].set_text(text)
-        prn.set_text(text)
+        for job in jobs:
+            job.stamp('render')
+        self.reflow()
+        for job in jobs:
+            job.stamp('rendered')
+        prn.print(preview=preview, jobs=jobs, copies=copies)
 
+    def _print_batch(self, data, preview):
+        """runs in GTK context"""
+        prn = self.prn
+        prn.print(preview=preview, data=data)
+
+        # show the last label
+        self._show(prn.barcode, prn.text)
         self.reflow()
-        prn.print(preview=preview)
 
     prn = None
-    amqp = None
+    servers = None # ServiceThread of the listeners
     _reflow_timer = None
+    _preview = None # (key, image) of the last label drawn
+    _showing_job = False # the editor is being filled in, not edited
+    _reflow_cost = 0.0 # seconds, a running average of updating the preview
+    _draw_cost = 0.0
+
+    # edits wait this long (ms) to be shown, depending on the cost of doing so
+    MIN_DELAY = 0
+    MAX_DELAY = 500
     
     def __init__(self, printer):
         #gnome.init(APPNAME, APPVERSION)
         super().__init__()
         self.prn = LabelPrinter(self, printer)
-        self.data = []
+        self.data = jobqueue.JobQueue(on_ready=self._ready)
 
         self.widgets = Gtk.Builder()
         self.widgets.add_from_file(APPNAME+".glade")
@@ -444,7 +1618,15 @@ class LabelUI(GObject.GObject):
 
     def _will_reflow(self):
         self._no_reflow()
-        self._reflow_timer = GObject.timeout_add(500, self._run_reflow)
+        # cheap updates happen right away, expensive ones once typing pauses
+        delay = int(3000 * (self._reflow_cost + self._draw_cost))
+        if delay < 20:
+            delay = self.MIN_DELAY
+        delay = min(delay, self.MAX_DELAY)
+        if delay:
+            self._reflow_timer = GObject.timeout_add(delay, self._run_reflow)
+        else:
+            self._reflow_timer = GObject.idle_add(self._run_reflow)
 
     def _no_reflow(self):
         if self._reflow_timer is None:
@@ -459,8 +1641,10 @@ class LabelUI(GObject.GObject):
     def reflow(self):
         self._no_reflow()
 
+        t = time.monotonic()
         if not self.prn.reflow(): # nothing to do
             return
+        self._reflow_cost = (self._reflow_cost + time.monotonic() - t) / 2
 
         preview = self['img_label']
         if preview is not None:
@@ -474,29 +1658,63 @@ class LabelUI(GObject.GObject):
     def on_draw_label(self, wid, ctx):
         if not self.prn or not self.prn.content:
             return
+        wp = wid.get_allocated_width()
+        hp = wid.get_allocated_height()
+        sf = wid.get_scale_factor()
+        key = (self.prn.content, wp, hp, sf)
+        if self._preview is None or self._preview[0] != key:
+            image = self.preview_image(wp, hp, sf)
+            if image is None:
+                # Sometimes draw() is called with a null surface
+                return
+            self._preview = (key, image)
         ctx.save()
-        ctx.set_source_rgb(1,1,1)
+        ctx.set_source_surface(self._preview[1], 0, 0)
         ctx.paint()
+        ctx.restore()
+
+    def preview_image(self, wp, hp, sf=1):
+        """Rasterize the label, scaled to fit @wp x @hp (times @sf, for
+        HiDPI screens)"""
         w = self.prn.width_px
         h = self.prn.height_px
-        #s = ctx.get_target()
-        #wp = s.get_width()
-        #hp = s.get_height()
-        s = wid
-        wp = wid.get_allocated_width()
-        hp = wid.get_allocated_height()
         p = min(wp/w, hp/h)
         if p < 0.01:
-            # Sometimes draw() is called with a null surface
-            return
+            return None
+        t = time.monotonic()
+        image = cairo.ImageSurface(cairo.FORMAT_RGB24, wp*sf, hp*sf)
+        image.set_device_scale(sf, sf)
+        ctx = cairo.Context(image)
+        ctx.set_source_rgb(1,1,1)
+        ctx.paint()
         ctx.scale(p,p)
         ctx.set_source_surface(self.prn.content, 0, 0)
         ctx.rectangle(*self.prn.content.ink_extents())
         ctx.set_antialias(cairo.ANTIALIAS_NONE)
-        ctx.paint()
-        ctx.restore()
+        ctx.fill()
+        del ctx
+        image.flush()
+        self._draw_cost = (self._draw_cost + time.monotonic() - t) / 2
+        return image
+
+    def _edited(self):
+        # a label typed in by hand has no image or template, whatever the
+        # last one from the queue had
+        if not self._showing_job:
+            self.prn.set_template(None)
+            self.prn.set_image(None)
+
+    def _show(self, barcode, text):
+        """Put a label from the queue into the editor"""
+        self._showing_job = True
+        try:
+            self['txt_code'].set_text(barcode)
+            self['label_buf'].set_text(text)
+        finally:
+            self._showing_job = False
 
     def on_barcode_changed(self, field):
+        self._edited()
         self.prn.set_barcode(field.get_text())
         self._will_reflow()
 
@@ -509,6 +1727,7 @@ class LabelUI(GObject.GObject):
 
     def on_text_changed(self, buf):
         txt = buf.get_text(buf.get_start_iter(),buf.get_end_iter(),False)
+        self._edited()
         self.prn.set_text(txt)
         self._will_reflow()
 
@@ -537,8 +1756,10 @@ class LabelUI(GObject.GObject):
         self._quit()
 
     def _quit(self):
-        if self.amqp is not None:
-            self.amqp.stop()
+        if self.servers is not None:
+            self.servers.stop()
+        if self.prn.ahead is not None:
+            self.prn.ahead.stop()
         Gtk.main_quit()
 
     def on_main_delete_event(self,window,event):
@@ -548,67 +1769,565 @@ class LabelUI(GObject.GObject):
     def on_quit_clicked(self,x):
         self._quit()
 
+class PrinterWorker:
+    """One printer of a Daemon, with its own LabelPrinter and queue.
+
+    Print jobs go to CUPS with lp (or to the raw printer), from a worker
+    thread so that the listener and the other printers keep going.
+    """
+    batch = 1 # max number of queued labels to print as one job
+    coalesce = 1 # max number of identical queued labels to print as copies of one
+    printing = False
+
+    def __init__(self, name=None, printer=None, width=38.0, settings=None, dpi=None, raw_dest=None):
+        """@settings override the print SETTINGS for this printer; @dpi
+        and @raw_dest, if given, override --dpi and --raw"""
+        self.name = name
+        self.dpi = dpi
+        self.raw_dest = raw_dest
+        self.prn = LabelPrinter(self, printer, settings=settings)
+        self.prn.set_width(width)
+        self.data = jobqueue.JobQueue(on_ready=self._ready)
+        self._wake = trio.Event()
+
+    def __repr__(self):
+        return "<PrinterWorker %s>" % (self.name or self.prn.selected_printer or "default",)
+
+    @property
+    def load(self):
+        """Labels this printer has to get through"""
+        return len(self.data) + self.printing
+
+    def _feed(self):
+        if self.prn.ahead is not None:
+            self.prn.ahead.feed(self.data)
+
+    def submit(self, data):
+        """Queue some labels. Runs in trio."""
+        self.data.put(data)
+        self._feed()
+
+    def _ready(self):
+        self._wake.set()
+
+    def check_print_job(self):
+        pass
+
+    async def run(self):
+        while True:
+            while not self.data:
+                await self._wake.wait()
+                self._wake = trio.Event()
+            data, copies = take(self.data, self.batch, self.coalesce)
+            mark_dequeued(data)
+            self._feed()
+            self.printing = True
+            try:
+                await trio.to_thread.run_sync(self.prn.spool, data, copies)
+            except Exception:
+                traceback.print_exc()
+                self.prn.jobs = [job for job in data if isinstance(job, Job)]
+                self.prn.finish("failed")
+            finally:
+                self.printing = False
+
+class Daemon:
+    """Print labels from AMQP without any windows, or Gtk at all.
+
+    Everything runs in trio. There is a PrinterWorker for each printer;
+    they print concurrently. A label goes to the printer named by its
+    "printer" field (a worker's name or CUPS queue), else to the least
+    busy printer of its "width" (mm), else to the worker named like the
+    message's routing key, else to the first one. With @spread, labels
+    for a busy printer go to an idle one of the same width instead.
+    """
+    spread = False
+
+    def __init__(self, printer=None, width=38.0, workers=()):
+        """@workers are (name, printer, width[, settings, dpi, raw_dest])
+        tuples, see PrinterWorker"""
+        workers = list(workers) or [(None, printer, width)]
+        self.workers = [PrinterWorker(*w) for w in workers]
+
+    @property
+    def prn(self):
+        return self.workers[0].prn
+
+    @property
+    def routes(self):
+        """Routing keys to listen on, besides the default"""
+        return [w.name for w in self.workers if w.name]
+
+    def route(self, rec, key=None):
+        """The worker to print record @rec on, which came with routing key @key"""
+        name = rec.get('printer')
+        width = rec.get('width')
+        if name:
+            for w in self.workers:
+                if name in (w.name, w.prn.selected_printer):
+                    break
+            else:
+                raise ValueError("Unknown printer: %r" % (name,))
+        elif width:
+            try:
+                width = float(width)
+            except (TypeError, ValueError):
+                raise ValueError("Bad width: %r" % (width,)) from None
+            ws = [w for w in self.workers if w.prn.PAGE_WIDTH == width]
+            if not ws:
+                raise ValueError("No printer for %g mm labels" % (width,))
+            return min(ws, key=lambda w: w.load)
+        else:
+            for w in self.workers:
+                if key and w.name == key:
+                    break
+            else:
+                w = self.workers[0]
+
+        if self.spread and w.load:
+            idle = [o for o in self.workers if not o.load and o.prn.PAGE_WIDTH == w.prn.PAGE_WIDTH]
+            if idle:
+                w = idle[0]
+        return w
+
+    def submit(self, data, key=None):
+        """Queue some labels. Runs in trio."""
+        by_worker = OrderedDict()
+        for rec in data:
+            by_worker.setdefault(self.route(rec, key), []).append(rec)
+        for w, recs in by_worker.items():
+            w.submit(recs)
+
+    def full(self):
+        return any(w.data.full() for w in self.workers)
+
+    def wait_space(self):
+        for w in self.workers:
+            w.data.wait_space()
+
+    def queued(self):
+        return sum(len(w.data) for w in self.workers)
+
+    async def run(self, services, task_status=None):
+        """Print what @services (listeners) receive"""
+        async with trio.open_nursery() as nursery:
+            for w in self.workers:
+                nursery.start_soon(w.run)
+            for service in services:
+                await nursery.start(service.listener)
+            if task_status is not None:
+                task_status.started()
+
+def trio_token():
+    # trio.hazmat was renamed to trio.lowlevel
+    lowlevel = getattr(trio, 'lowlevel', None) or trio.hazmat
+    return lowlevel.current_trio_token()
+
+async def make_jobs(ui, body, key=None):
+    """Jobs for the records in message @body, checked so that @ui can
+    print them. Raises an exception if they are no good.
+
+    Images are loaded on a worker thread, to keep file reads and decoding
+    out of the event loop."""
+    data = [Job(d) for d in records.parse_body(body.decode("utf-8"))]
+    images = []
+    for job in data:
+        prn = ui.route(job, key).prn
+        prn.template_for(job)
+        if job.get('image'):
+            images.append((prn, job))
+    if images:
+        await trio.to_thread.run_sync(load_assets, images)
+    return data
+
+def load_assets(images):
+    """Load the images of (printer, job) pairs @images into the jobs"""
+    for prn, job in images:
+        job.asset = prn.asset_for(job['image'])
+
+def overall_status(jobs):
+    states = set(job.status for job in jobs)
+    if states <= {"ok"}: # no jobs went fine, too
+        return "ok"
+    if "failed" in states:
+        return "failed"
+    return "cancelled"
+
+def when_done(jobs, fn):
+    """Call @fn() once all @jobs are done, in the thread finishing the last"""
+    left = [len(jobs)]
+    lock = threading.Lock()
+    def done(job):
+        with lock:
+            left[0] -= 1
+            if left[0]:
+                return
+        fn()
+    for job in jobs:
+        job.add_done_callback(done)
+
 class Listener:
+    """Receive labels from AMQP.
+
+    A message is answered (if it has a reply_to) when all of its labels
+    have been printed, with a JSON object that has the overall "status"
+    and a report of each job. With ack_after_print, the message is also
+    acknowledged only then; otherwise as soon as its labels are queued.
+
+    Normally each instance gets a private queue, i.e. a copy of every
+    message. With a "queue" name, it consumes from that durable queue
+    instead, which any number of instances can share; labels are then
+    acknowledged after printing, so the broker hands those of an instance
+    that dies to another.
+
+    Lost connections are made again, waiting longer after each failure.
+    With ack_after_print, the broker delivers the messages of a lost
+    connection again: their labels that are still queued are dropped, and
+    those already printing are neither answered nor acknowledged. Other
+    messages are answered on whichever connection is there when they are
+    done. @connect stands in for trio_amqp.connect_amqp.
+    """
     gate = None
+    _nursery = None # outlives the connections, for _completed
+    _channel = None # of the current connection
+    _connected = None # trio.Event, set while there is a connection
+    RETRY_MIN = 1 # seconds until reconnecting; doubles up to
+    RETRY_MAX = 60
 
-    def __init__(self, ui, args):
+    def __init__(self, ui, args, connect=None):
         self.ui = ui
         self.args = args
-        self.done = trio.Event()
+        self.queue = args.get('queue') or None
+        self.ack_after_print = args.get('ack_after_print', False) or self.queue is not None
+        self.connect = connect
 
     async def on_request(self, channel, body, envelope, properties):
-        try:
-            data = json.loads(body.decode("utf-8"))
-            #GObject.idle_add(self._print,data['barcode'],data['text'])
-            self.ui.data.append(data)
-            GObject.idle_add(self.ui.emit, "run_print", False) # emit the signal
-
-        except BaseException as exc:
-            res = str(exc)
-        else:
-            res = "OK"
-
-        if properties.reply_to:
-            await channel.basic_publish(
-                payload=bytes(res),
-                exchange_name='',
-                routing_key=properties.reply_to,
-                properties={ 'correlation_id': properties.correlation_id, },
-            )
+        await self.wait_space()
+        with tracing.span("amqp receive", bytes=len(body), routing_key=envelope.routing_key) as sp:
+            try:
+                data = await make_jobs(self.ui, body, envelope.routing_key)
+            except Exception as exc:
+                data = None
+                error = exc
+                sp.set(error=str(exc))
+            else:
+                sp.set(jobs=[job.id for job in data])
+                jobs_received.inc(len(data))
+                if self.ack_after_print:
+                    for job in data:
+                        job.origin = channel
+                if data and (properties.reply_to or self.ack_after_print):
+                    self._watch(channel, envelope, properties, data)
+                #GObject.idle_add(self._print,data['barcode'],data['text'])
+                self.ui.submit(data, envelope.routing_key)
+        if data is None:
+            jobs_rejected.inc()
+            await self._reply(channel, properties, dict(status="error", error=str(error)))
+            await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+            return
 
-        await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+        if not data:
+            # nothing to wait for
+            await self._reply(channel, properties, dict(status="ok", jobs=[]))
+        if not data or not self.ack_after_print:
+            await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
 
-    async def listener(self, task_status=trio.TASK_STATUS_IGNORED):
+    async def wait_space(self):
+        """Don't take on more labels while the queue is full"""
+        if self.ui.full():
+            await trio.to_thread.run_sync(self.ui.wait_space, cancellable=True)
 
-        async with trio_amqp.connect_amqp(host=self.args['host'], login=self.args['login'], password=self.args['password'], virtualhost=self.args['vhost']) as protocol:
+    def _watch(self, channel, envelope, properties, jobs):
+        """Arrange for _completed to run when all @jobs are done"""
+        def done():
+            try:
+                self.gate(self._spawn, self._completed, channel, envelope, properties, jobs)
+            except trio.RunFinishedError:
+                pass # shutting down
+        when_done(jobs, done)
+
+    def _spawn(self, fn, *args):
+        # runs in trio
+        if self._nursery is not None:
+            self._nursery.start_soon(fn, *args)
+
+    async def _completed(self, channel, envelope, properties, jobs):
+        if self.ack_after_print and channel is not self._channel:
+            # the message comes again, and is answered then
+            print("Connection lost before jobs %s were done; not reporting them" % (
+                ", ".join(str(job.id) for job in jobs),), file=sys.stderr)
+            return
+        status = overall_status(jobs)
+        try:
+            if properties.reply_to:
+                # the reply goes to the producer's queue: any channel will do
+                while self._channel is None:
+                    await self._connected.wait()
+                await self._reply(self._channel, properties, dict(status=status, jobs=[job.report() for job in jobs]))
+            if self.ack_after_print:
+                await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+        except Exception as exc:
+            # the broker will redeliver unacked messages
+            print("Could not report on jobs:", repr(exc), file=sys.stderr)
+
+    def _disconnected(self, channel):
+        """Drop the queued labels that the broker will deliver again"""
+        if not self.ack_after_print:
+            return
+        dropped = []
+        for w in self.ui.workers:
+            dropped += w.data.remove(lambda job: getattr(job, 'origin', None) is channel)
+        for job in dropped:
+            job.set_done("cancelled")
+        if dropped:
+            print("Dropped %d queued labels of the lost connection" % (len(dropped),), file=sys.stderr)
+
+    async def _reply(self, channel, properties, res):
+        if not properties.reply_to:
+            return
+        await channel.basic_publish(
+            payload=json.dumps(res).encode("utf-8"),
+            exchange_name='',
+            routing_key=properties.reply_to,
+            properties={ 'correlation_id': properties.correlation_id, 'content_type': "application/json", },
+        )
+
+    async def listener(self, task_status=None):
+        if self.gate is None:
+            self.gate = trio_token().run_sync_soon
+
+        delay = self.RETRY_MIN
+        def connected():
+            nonlocal delay
+            delay = self.RETRY_MIN
+            report_startup("Accepting labels")
+
+        self._connected = trio.Event()
+        try:
+            async with trio.open_nursery() as nursery:
+                self._nursery = nursery
+                # don't hold up the other services until the broker is there
+                if task_status is not None:
+                    task_status.started()
+                while True:
+                    try:
+                        await self.consume(connected)
+                    except Exception as exc:
+                        print("AMQP connection failed: %r" % (exc,), file=sys.stderr)
+                    else:
+                        print("AMQP connection closed", file=sys.stderr)
+                    print("Reconnecting in %g s" % (delay,), file=sys.stderr)
+                    await trio.sleep(delay)
+                    delay = min(delay*2, self.RETRY_MAX)
+                    amqp_reconnects.inc()
+        finally:
+            self._nursery = None
+
+    async def consume(self, connected):
+        """Connect and process messages until the connection ends;
+        call @connected once ready"""
+        connect = self.connect or trio_amqp.connect_amqp
+        exchange = self.args['exchange']
+        async with connect(host=self.args['host'], login=self.args['login'], password=self.args['password'], virtualhost=self.args['vhost']) as protocol:
             async with protocol.new_channel() as channel:
 
-                await channel.exchange_declare(self.args['exchange'], "topic")
-                q = await channel.queue_declare(exclusive=True)
-                await channel.queue_bind(q['queue'], self.args['exchange'], routing_key=self.args['route'])
-                await channel.basic_qos(prefetch_count=1, prefetch_size=0, connection_global=False)
+                if self.queue is not None:
+                    q = await channel.queue_declare(queue_name=self.queue, durable=True)
+                else:
+                    q = await channel.queue_declare(exclusive=True)
+                # the default exchange routes by queue name, without bindings
+                if exchange:
+                    await channel.exchange_declare(exchange, "topic")
+                    for route in [self.args['route']] + list(self.ui.routes):
+                        await channel.queue_bind(q['queue'], exchange, routing_key=route)
+                await channel.basic_qos(prefetch_count=self.args.get('prefetch', 1), prefetch_size=0, connection_global=False)
             
                 async with channel.new_consumer(queue_name=q['queue']) as listener:
-                    task_status.started()
-                    async for body, envelope, properties in listener:
-                        await self.on_request(channel, body, envelope, properties)
+                    self._channel = channel
+                    self._connected.set()
+                    try:
+                        connected()
+                        async for body, envelope, properties in listener:
+                            await self.on_request(channel, body, envelope, properties)
+                    finally:
+                        self._channel = None
+                        self._connected = trio.Event()
+                        self._disconnected(channel)
+
+class LocalListener:
+    """Take labels from programs on this machine, without a broker.
+
+    This speaks just enough HTTP, on a Unix socket and/or a localhost
+    port:
+
+        POST /print     the body is a label record, a JSON array of them,
+                        or one per line. Answers 202 with the job IDs;
+                        with ?wait=1, answers once they are printed, with
+                        their status and timing like an AMQP reply.
+        GET /queue      the number of labels waiting
+
+    Errors are answered with a JSON object with status "error".
+    """
+    MAX_HEADER = 16<<10
+    MAX_BODY = 16<<20
+
+    def __init__(self, ui, path=None, port=None):
+        self.ui = ui
+        self.path = path
+        self.port = port
+
+    async def listener(self, task_status=None):
+        listeners = []
+        if self.path:
+            self._remove_stale()
+            sock = trio.socket.socket(trio.socket.AF_UNIX, trio.socket.SOCK_STREAM)
+            await sock.bind(self.path)
+            sock.listen()
+            listeners.append(trio.SocketListener(sock))
+        if self.port:
+            listeners.extend(await trio.open_tcp_listeners(self.port, host="127.0.0.1"))
+        report_startup("Accepting labels")
+        if task_status is not None:
+            task_status.started()
+        try:
+            await trio.serve_listeners(self.handle, listeners)
+        finally:
+            if self.path:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+
+    def _remove_stale(self):
+        """Remove the socket a dead instance left at our path. Anything
+        else there is left alone, and bind() will fail."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(st.st_mode):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            os.unlink(self.path)
+        else:
+            raise RuntimeError("Another instance is listening on %s" % (self.path,))
+        finally:
+            probe.close()
 
-    async def _in_trio(self, done):
-        self.gate = trio.hazmat.current_trio_token().run_sync_soon
+    async def handle(self, stream):
+        try:
+            req = await self._read(stream)
+            if req is None:
+                return
+            try:
+                code, res = await self.request(*req)
+            except Exception as exc:
+                traceback.print_exc()
+                code, res = 500, dict(status="error", error=str(exc))
+            await self._respond(stream, code, res)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass # the client went away
+        finally:
+            await stream.aclose()
+
+    async def _read(self, stream):
+        """Read a request; returns method, target and body"""
+        buf = b""
+        while b"\r\n\r\n" not in buf:
+            data = await stream.receive_some(65536)
+            if not data:
+                return None
+            buf += data
+            if len(buf) > self.MAX_HEADER + self.MAX_BODY:
+                return None
+        head, _, body = buf.partition(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                k, _, v = line.partition(":")
+                headers[k.strip().lower()] = v.strip()
+            n = int(headers.get("content-length", 0))
+        except ValueError:
+            return None
+        if n > self.MAX_BODY:
+            return None
+        while len(body) < n:
+            data = await stream.receive_some(n - len(body))
+            if not data:
+                return None
+            body += data
+        return method, target, body[:n]
+
+    async def _respond(self, stream, code, res):
+        body = json.dumps(res).encode("utf-8")
+        head = "HTTP/1.0 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % (
+            code, {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found"}.get(code, "Error"), len(body))
+        await stream.send_all(head.encode("ascii") + body)
+
+    async def request(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == "/queue" and method == "GET":
+            return 200, dict(queued=self.ui.queued())
+        if url.path != "/print":
+            return 404, dict(status="error", error="Not found: %s" % (url.path,))
+        if method != "POST":
+            return 400, dict(status="error", error="Use POST to print")
+
+        if self.ui.full():
+            await trio.to_thread.run_sync(self.ui.wait_space, cancellable=True)
+        wait = query.get("wait", ["0"])[-1].lower() in ("1", "true", "yes")
+        with tracing.span("local receive", bytes=len(body), wait=wait) as sp:
+            try:
+                jobs = await make_jobs(self.ui, body)
+            except Exception as exc:
+                jobs_rejected.inc()
+                sp.set(error=str(exc))
+                return 400, dict(status="error", error=str(exc))
+            sp.set(jobs=[job.id for job in jobs])
+            jobs_received.inc(len(jobs))
+
+            if wait and jobs:
+                done = trio.Event()
+                token = trio_token()
+                when_done(jobs, lambda: token.run_sync_soon(done.set))
+            self.ui.submit(jobs)
+        if not wait:
+            return 202, dict(status="queued", jobs=[job.id for job in jobs])
+        if jobs:
+            await done.wait()
+        return 200, dict(status=overall_status(jobs), jobs=[job.report() for job in jobs])
+
+class ServiceThread:
+    """Run listeners on trio, in a thread of their own, alongside Gtk"""
+    gate = None
+
+    def __init__(self, services):
+        self.services = services
+        self.done = trio.Event()
+
+    async def _in_trio(self, started):
+        self.gate = trio_token().run_sync_soon
 
         async with trio.open_nursery() as nursery:
-            await nursery.start(self.listener)
-            done.set()
+            for service in self.services:
+                await nursery.start(service.listener)
+            started.set()
             await self.done.wait()
             nursery.cancel_scope.cancel()
 
-    def _start_trio(self, done):
-        trio.run(self._in_trio, done)
+    def _start_trio(self, started):
+        trio.run(self._in_trio, started)
 
     def start(self):
-        done = threading.Event()
-        threading.Thread(target=self._start_trio, args=(done,)).start()
-        done.wait()
+        started = threading.Event()
+        threading.Thread(target=self._start_trio, args=(started,), name="trio").start()
+        started.wait()
 
     def stop(self):
         if self.gate is not None and self.done is not None:
@@ -617,33 +2336,202 @@ class Listener:
             except trio.RunFinishedError:
                 pass
 
-@click.command()
-@click.option('-o','--printer', help="Print queue to use by default", default="")
+def parse_worker(spec, width):
+    """Parse ROUTE=PRINTER[@WIDTH][,OPTION=VALUE...]. PRINTER is a CUPS
+    queue, or a raw printer's unix: or tcp: address. An OPTION is "dpi",
+    "raw" (like --raw) or a print setting such as cups-BytesPerLine.
+    Returns the arguments of a PrinterWorker."""
+    spec, *options = spec.split(",")
+    route, sep, printer = spec.partition("=")
+    if not sep or not route or not printer:
+        raise click.BadParameter("%r is not ROUTE=PRINTER[@WIDTH][,OPTION=VALUE...]" % (spec,), param_hint="--worker")
+    if "@" in printer:
+        printer, w = printer.rsplit("@", 1)
+        try:
+            width = float(w)
+        except ValueError:
+            raise click.BadParameter("%r: bad width" % (spec,), param_hint="--worker") from None
+    settings = {}
+    dpi = raw_dest = None
+    for opt in options:
+        k, sep, v = opt.partition("=")
+        if not sep or not k:
+            raise click.BadParameter("%r: %r is not OPTION=VALUE" % (spec, opt), param_hint="--worker")
+        if k == "dpi":
+            try:
+                dpi = int(v)
+            except ValueError:
+                raise click.BadParameter("%r: bad dpi" % (spec,), param_hint="--worker") from None
+        elif k == "raw":
+            raw_dest = v
+        else:
+            settings[k] = v
+    return route, printer, width, settings, dpi, raw_dest
+
+@click.group(invoke_without_command=True)
+@click.option('-o','--printer', help="Print queue to use by default")
 @click.option('-h','--host', help="AMQP host to connect to", default="")
 @click.option('-l','--login', help="AMQP user name", default="guest")
 @click.option('-p','--password', help="AMQP password", default="guest")
 @click.option('-v','--vhost', help="AMQP virtual host to use", default="/")
 @click.option('-x','--exchange', help="Exchange to link to", default="")
 @click.option('-r','--route', help="Routing key to listen on", default="")
-def main(printer, **args):
+@click.option('-q','--queue', help="Share this durable AMQP queue with other instances (implies --ack-after-print)")
+@click.option('-P','--prefetch', type=int, default=1, help="AMQP messages to receive before acknowledging any")
+@click.option('-A','--ack-after-print', is_flag=True, help="Acknowledge AMQP messages only after their labels are printed")
+@click.option('-s','--socket', 'socket_path', help="Also take labels over HTTP on this Unix socket")
+@click.option('--http', 'http_port', type=int, help="Also take labels over HTTP on this localhost port")
+@click.option('-D','--daemon', is_flag=True, help="Print from AMQP without a window (needs --host)")
+@click.option('-w','--width', type=float, default=38.0, help="Label width in mm (daemon)")
+@click.option('-W','--worker', 'worker_specs', multiple=True, help="A printer for the daemon, as ROUTE=PRINTER[@WIDTH][,OPTION=VALUE...] with OPTIONs dpi, raw or print settings; repeat for more")
+@click.option('-S','--spread', is_flag=True, help="Send labels for a busy printer to an idle one of the same width")
+@click.option('--raw', help="Send 1-bit rasters here instead of printing via CUPS (file, unix:PATH, tcp:HOST:PORT)")
+@click.option('--dpi', type=int, help="Resolution of the printer(s) to lay labels out for (default: from the print settings, %d for raw printers)" % (RAW_DPI,))
+@click.option('-b','--batch', type=int, default=1, help="Print up to this many queued labels as one job")
+@click.option('-c','--coalesce', type=int, default=20, help="Print up to this many identical queued labels as copies of one (1: off)")
+@click.option('--max-queued', type=int, default=1000, help="Stop taking labels from AMQP while this many are waiting (0: no limit)")
+@click.option('-a','--render-ahead', type=int, default=0, help="Render this many queued labels in advance (0: off)")
+@click.option('--render-workers', type=int, default=2, help="Threads for rendering in advance")
+@click.option('-m','--metrics', 'metrics_port', type=int, default=0, help="Serve metrics on this local HTTP port")
+@click.option('--startup-budget', 'budget', type=float, help="Warn if accepting labels takes longer than this (seconds)")
+@click.option('-t','--templates', 'template_file', type=click.Path(exists=True, dir_okay=False), help="JSON file with label templates for records to choose from")
+@click.option('--assets', type=click.Path(exists=True, file_okay=False), default=".", help="Where the images named by records are")
+@click.option('--cache-entries', type=int, default=label_cache.max_entries, help="Max number of finished labels to keep")
+@click.option('--cache-size', type=float, default=label_cache.max_size/(1<<20), help="Max memory (MB) for finished labels")
+@click.option('--trace', 'trace_file', type=click.Path(dir_okay=False, writable=True), help="Record what each job spends its time on to this trace-event JSON file")
+@click.option('--trace-events', type=int, default=100000, help="Start a new trace file after this many events, keeping 3 old ones")
+@click.pass_context
+def main(ctx, printer, socket_path, http_port, daemon, width, worker_specs, spread, raw, dpi, batch, coalesce, max_queued, render_ahead, render_workers, metrics_port, budget, template_file, assets, cache_entries, cache_size, trace_file, trace_events, **args):
+    """Print labels. Without a command, start the label editor."""
+    global startup_budget
+    startup_budget = budget
+    if trace_file:
+        tracing.start(trace_file, max_events=trace_events)
+    LabelPrinter.asset_dir = assets
+    if template_file:
+        try:
+            LabelPrinter.templates = templates.read(template_file)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), param_hint="--templates")
+    label_cache.resize(max_entries=cache_entries, max_size=int(cache_size*(1<<20)))
+    if ctx.invoked_subcommand is not None:
+        return
     if printer:
         SETTINGS['printer'] = printer
 
-    ui = LabelUI(printer)
+    if args.get('host','') and not importable('trio_amqp'):
+        print("I could not import Trio-AMQP -- remote printing disabled", file=sys.stderr)
+        sys.exit(1)
+    if daemon:
+        if not (args.get('host','') or socket_path or http_port):
+            raise click.UsageError("--daemon needs an AMQP --host, or a --socket or --http port")
+        workers = [parse_worker(spec, width) for spec in worker_specs]
+        ui = Daemon(printer, width, workers)
+        ui.spread = spread
+    else:
+        if worker_specs:
+            raise click.UsageError("Only a --daemon can have several printers")
+        Gdk.threads_init()
+        ui = LabelUI(printer)
+    for w in ui.workers:
+        w.batch = batch
+        w.coalesce = coalesce
+        w.data.maxsize = max_queued
+        if w.raw_dest:
+            w.prn.raw = raster.Sink(w.raw_dest)
+        elif w.prn.selected_printer and w.prn.selected_printer.startswith(("unix:", "tcp:")):
+            w.prn.raw = raster.Sink(w.prn.selected_printer)
+        elif raw:
+            w.prn.raw = raster.Sink(raw)
+        wdpi = w.dpi or dpi
+        if w.prn.raw is not None or wdpi:
+            w.prn.set_dpi(wdpi or RAW_DPI)
+            w.prn.auto_dpi = False
+        if render_ahead > 0:
+            w.prn.ahead = RenderAhead(w.prn, render_ahead, render_workers)
+    queue_depth.set_function(ui.queued)
+    if metrics_port:
+        metrics.serve(metrics_port)
+
+    services = []
+    if args.get('host',''):
+        services.append(Listener(ui, args))
+    if socket_path or http_port:
+        services.append(LocalListener(ui, socket_path, http_port))
+
+    if daemon:
+        try:
+            trio.run(ui.run, services)
+        except KeyboardInterrupt:
+            pass
+        return
+
     ui.init_done()
 
-    if args.get('host',''):
-        if threading is None:
-            print("I could not import Trio-AMQP -- remote printing disabled", file=sys.stderr)
-            sys.exit(1)
-        ui.amqp = Listener(ui, args)
-        ui.amqp.start()
+    if services:
+        ui.servers = ServiceThread(services)
+        ui.servers.start()
+    else:
+        report_startup("Editor ready")
 
     try:
         Gtk.main()
     except KeyboardInterrupt:
-        if ui.amqp is not None:
-            ui.amqp.stop()
+        if ui.servers is not None:
+            ui.servers.stop()
+
+@main.command()
+@click.option('-f','--format', 'fmt', type=click.Choice(('auto',)+records.FORMATS), default='auto', help="Input format (default: by file name, else JSON lines)")
+@click.option('-w','--width', type=float, default=38.0, help="Label width in mm")
+@click.option('-q','--quiet', is_flag=True, help="Only print the total")
+@click.argument('input', type=click.File('r'), default='-')
+def measure(fmt, width, quiet, input):
+    """Compute how much label roll a batch will use, without drawing.
+
+    Prints the length (mm, including margins) and font size of each
+    label, then the total.
+    """
+    prn = LabelPrinter(None)
+    prn.set_width(width)
+    total = 0
+    n = 0
+    for rec in records.read_records(input, fmt):
+        h, fs = prn.measure(rec['barcode'], '\n'.join(rec['text']), prn.template_for(rec),
+            prn.asset_for(rec.get('image')))
+        h += prn.TOP_MARGIN+prn.BOTTOM_MARGIN
+        total += h
+        n += 1
+        if not quiet:
+            print("%.1f\t%d\t%s" % (h, fs, rec['barcode']))
+    print("%d labels, %.1f mm" % (n, total))
+
+@main.command()
+@click.option('-f','--format', 'fmt', type=click.Choice(('auto',)+records.FORMATS), default='auto', help="Input format (default: by file name, else JSON lines)")
+@click.option('-w','--width', type=float, default=38.0, help="Label width in mm")
+@click.option('-O','--output', required=True, help="Output: a PDF file, a PNG name with %d for the label number, or a raw raster file (*.raw, unix:PATH, tcp:HOST:PORT)")
+@click.option('-d','--dpi', type=int, default=300, help="Resolution of the printer; bars are snapped to its dots, and PNG or raw output has it")
+@click.argument('input', type=click.File('r'), default='-')
+def render(fmt, width, output, dpi, input):
+    """Render labels to PDF, PNG or 1-bit rasters without a display.
+
+    INPUT contains one JSON object per line, or CSV rows with the barcode
+    in the first column and the text lines after it.
+    """
+    prn = LabelPrinter(None)
+    prn.set_width(width)
+    prn.set_dpi(dpi)
+    data = records.read_records(input, fmt)
+
+    if output.startswith(('unix:','tcp:')) or output.lower().endswith('.raw'):
+        n = render_raw(prn, data, output, dpi)
+    elif output.lower().endswith('.png'):
+        if '%' not in output:
+            base, ext = os.path.splitext(output)
+            output = base + '-%05d' + ext
+        n = render_png(prn, data, output, dpi)
+    else:
+        n = render_pdf(prn, data, output)
+    print("%d labels written" % (n,), file=sys.stderr)
 
 if __name__ == '__main__':
     main(standalone_mode=False)
@@ -0,0 +1,158 @@
+"""
+Minimal Prometheus-style metrics.
+
+Counters, gauges and histograms register themselves with REGISTRY.
+serve() exposes them in the Prometheus text format on a local HTTP port,
+from a background thread.
+"""
+
+import math
+import threading
+
+# seconds; covers both a cached replay and a slow printer
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        with self._lock:
+            metrics = list(self.metrics)
+        lines = []
+        for m in metrics:
+            lines.append("# HELP %s %s" % (m.name, m.help))
+            lines.append("# TYPE %s %s" % (m.name, m.kind))
+            lines.extend(m.samples())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k,v in pairs)
+
+def _num(v):
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v))
+
+class _Metric:
+    kind = None
+    _fn = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(k, "") for k in self.labels)
+
+    def set_function(self, fn):
+        """Read the value from @fn whenever it's needed. With labels, @fn
+        returns a dict of values by tuple of label values."""
+        self._fn = fn
+
+    def _items(self):
+        if self._fn is not None:
+            v = self._fn()
+            if not self.labels:
+                return [((), v)]
+            return sorted(v.items())
+        with self._lock:
+            return sorted(self._values.items())
+
+    def get(self, **labels):
+        if self._fn is not None:
+            v = self._fn()
+            return v.get(self._key(labels), 0) if self.labels else v
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        return ["%s%s %s" % (self.name, _labels(self.labels, k), _num(v)) for k,v in self._items()]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets) + (math.inf,)
+        super().__init__(name, help, labels, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                h = self._values[key] = [[0]*len(self.buckets), 0, 0.0]
+            for i,b in enumerate(self.buckets):
+                if value <= b:
+                    h[0][i] += 1
+                    break
+            h[1] += 1
+            h[2] += value
+
+    def samples(self):
+        res = []
+        with self._lock:
+            items = sorted((k, (list(c), n, s)) for k,(c,n,s) in self._values.items())
+        for key,(counts,n,total) in items:
+            acc = 0
+            for b,c in zip(self.buckets, counts):
+                acc += c
+                res.append("%s_bucket%s %d" % (self.name, _labels(self.labels, key, [("le", _num(b))]), acc))
+            res.append("%s_count%s %d" % (self.name, _labels(self.labels, key), n))
+            res.append("%s_sum%s %s" % (self.name, _labels(self.labels, key), _num(total)))
+        return res
+
+def serve(port, host="127.0.0.1", registry=REGISTRY):
+    """Serve @registry on http://@host:@port/metrics in a daemon thread"""
+    # imported here as most runs don't need it
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.exposition().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *a):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
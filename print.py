@@ -8,6 +8,7 @@ import sys
 import trio
 import json
 import trio_amqp
+import records
 
 async def handle_return(channel, body, envelope, properties):
     print('Got a returned message with routing key: {}.\n'
@@ -24,21 +25,40 @@ async def get_returns(chan, task_status=trio.TASK_STATUS_IGNORED):
         await handle_return(chan, body, envelope, properties)
 
 
+def labels(args):
+    if args['file'] is not None:
+        return records.read_records(args['file'], args['format'])
+    if not args['barcode'] and not args['text']:
+        raise click.UsageError("Need a barcode and text, or --file")
+    return [records.normalize(dict(barcode=args['barcode'] or "", text=list(args['text'])))]
+
 async def send(args):
     async with trio_amqp.connect_amqp(host=args['host'], login=args['login'], password=args['password'], virtualhost=args['vhost']) as protocol:
         channel = await protocol.channel()
         await protocol.nursery.start(get_returns, channel)
 
         await channel.queue_declare(exclusive=True)
+        # basic_publish now waits until the broker has the message
+        await channel.confirm_select()
 
-        await channel.basic_publish(
-            payload=json.dumps(dict(barcode=args['barcode'], text=args['text'])).encode("utf-8"),
-            exchange_name=args['exchange'],
-            routing_key=args['route'],  # typo on purpose, will cause the return
-            mandatory=True,
-        )
+        n = 0
+        batches = records.batches(labels(args), args['batch'])
+        while True:
+            # reading may block (stdin), so don't do it in the event loop
+            batch = await trio.to_thread.run_sync(next, batches, None)
+            if batch is None:
+                break
+            # a single label is sent as a plain object, as before
+            data = batch[0] if len(batch) == 1 else batch
 
-        await trio.sleep(3)
+            await channel.basic_publish(
+                payload=json.dumps(data).encode("utf-8"),
+                exchange_name=args['exchange'],
+                routing_key=args['route'],
+                mandatory=True,
+            )
+            n += len(batch)
+        return n
 
 @click.command()
 @click.option('-h','--host', help="AMQP host to connect to", default="localhost")
@@ -47,10 +67,15 @@ async def send(args):
 @click.option('-v','--vhost', help="AMQP virtual host to use", default="/")
 @click.option('-x','--exchange', help="Exchange to link to", default="")
 @click.option('-r','--route', help="Routing key to listen on", default="")
-@click.argument("barcode", nargs=1)
+@click.option('-f','--file', type=click.File('r'), help="Send the labels in this file ('-' for stdin) instead")
+@click.option('--format', type=click.Choice(('auto',)+records.FORMATS), default='auto', help="Format of --file (default: by file name, else JSON lines)")
+@click.option('-n','--batch', type=int, default=100, help="Labels per message when sending a file")
+@click.argument("barcode", nargs=1, required=False)
 @click.argument("text", nargs=-1)
 async def run(**args):
-    await send(args)
+    n = await send(args)
+    if args['file'] is not None:
+        print("%d labels sent" % (n,), file=sys.stderr)
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+"""
+Raw 1-bit label rasters, and where to send them.
+
+Each label is sent as one frame:
+
+    b"LPR1"                 magic
+    width, height           uint32 each, in dots
+    bytes_per_line          uint32
+    dpi, copies             uint16 each
+    height * bytes_per_line bytes of row data
+
+All numbers are big-endian. Rows are packed eight dots per byte, the
+leftmost dot in the most significant bit, 1 meaning black; that is the
+same layout as the data of a binary PBM file.
+
+A destination is a file name, "unix:/path/to/socket" or "tcp:host:port".
+Running this module listens on such a socket and saves every frame it
+receives as a PBM file, so it can stand in for a printer.
+"""
+
+import os
+import socket
+import struct
+
+_numpy = False # not imported yet
+
+def _get_numpy():
+    # numpy is optional, and slow to import
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+MAGIC = b"LPR1"
+HEADER = struct.Struct(">4sIIIHH")
+
+def pack(buf, width, height, stride, bytes_per_line=None, align="left"):
+    """Pack a cairo RGB24/ARGB32 image into 1-bit rows.
+
+    Dark pixels (green channel below half) become black dots. Rows are
+    padded to @bytes_per_line, placing the image according to @align.
+    Returns the bytes per line and the packed data.
+    """
+    bpl = (width+7)//8
+    if bytes_per_line is None or bytes_per_line < bpl:
+        bytes_per_line = bpl
+    pad = bytes_per_line*8 - width
+    if align == "right":
+        left = pad
+    elif align == "center":
+        left = pad//2
+    else:
+        left = 0
+
+    numpy = _get_numpy()
+    if numpy is not None:
+        a = numpy.frombuffer(buf, dtype=numpy.uint8, count=height*stride)
+        # byte 1 of each little-endian 32-bit pixel is green
+        a = a.reshape(height, stride)[:, 1:width*4:4] < 128
+        if pad:
+            a = numpy.pad(a, ((0,0), (left, pad-left)), constant_values=False)
+        return bytes_per_line, numpy.packbits(a, axis=1).tobytes()
+
+    buf = bytes(buf)
+    res = bytearray()
+    for y in range(height):
+        row = buf[y*stride+1 : y*stride+width*4 : 4]
+        bits = 0
+        for g in row:
+            bits = (bits << 1) | (g < 128)
+        bits <<= pad-left
+        res += bits.to_bytes(bytes_per_line, "big")
+    return bytes_per_line, bytes(res)
+
+def frame(width, height, bytes_per_line, data, dpi, copies=1):
+    return HEADER.pack(MAGIC, width, height, bytes_per_line, dpi, copies) + data
+
+def _read(stream, n):
+    buf = b""
+    while len(buf) < n:
+        d = stream.read(n-len(buf))
+        if not d:
+            if buf:
+                raise EOFError("truncated frame")
+            return None
+        buf += d
+    return buf
+
+def read_frame(stream):
+    """Read one frame from a binary file object.
+
+    Returns (width, height, bytes_per_line, dpi, copies, data),
+    or None at the end of the stream.
+    """
+    hdr = _read(stream, HEADER.size)
+    if hdr is None:
+        return None
+    magic, width, height, bpl, dpi, copies = HEADER.unpack(hdr)
+    if magic != MAGIC:
+        raise ValueError("not a label raster: %r" % (magic,))
+    data = _read(stream, height*bpl)
+    if data is None and height*bpl:
+        raise EOFError("truncated frame")
+    return width, height, bpl, dpi, copies, data or b""
+
+def to_pbm(width, height, bytes_per_line, data):
+    return ("P4\n%d %d\n" % (bytes_per_line*8, height)).encode("ascii") + data
+
+def _address(dest):
+    if dest.startswith("unix:"):
+        return socket.AF_UNIX, dest[5:]
+    if dest.startswith("tcp:"):
+        host, port = dest[4:].rsplit(":", 1)
+        return socket.AF_INET, (host or "localhost", int(port))
+    return None, dest
+
+class Sink:
+    """Somewhere to send label rasters to.
+
+    A file is started afresh, and only appended to when it is opened
+    again after an error.
+    """
+    def __init__(self, dest):
+        self.dest = dest
+        self._file = None
+        self._sock = None
+        self._opened = False
+
+    def _open(self):
+        family, addr = _address(self.dest)
+        if family is None:
+            self._file = open(addr, "ab" if self._opened else "wb")
+            self._opened = True
+        else:
+            self._sock = socket.socket(family, socket.SOCK_STREAM)
+            self._sock.connect(addr)
+            self._file = self._sock.makefile("wb")
+
+    def write(self, data):
+        if self._file is None:
+            self._open()
+        try:
+            self._file.write(data)
+            self._file.flush()
+        except OSError:
+            # the printer went away: try again once, on a new connection
+            self.close()
+            self._open()
+            self._file.write(data)
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+def listen(dest, out_dir):
+    """Accept connections on @dest and save each frame as a PBM file"""
+    family, addr = _address(dest)
+    if family is None:
+        raise ValueError("Need a socket to listen on, not %r" % (dest,))
+    if family == socket.AF_UNIX and os.path.exists(addr):
+        os.unlink(addr)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(addr)
+    sock.listen(1)
+    n = 0
+    while True:
+        conn, _ = sock.accept()
+        with conn, conn.makefile("rb") as f:
+            while True:
+                fr = read_frame(f)
+                if fr is None:
+                    break
+                width, height, bpl, dpi, copies, data = fr
+                n += 1
+                name = os.path.join(out_dir, "label-%05d.pbm" % (n,))
+                with open(name, "wb") as pbm:
+                    pbm.write(to_pbm(width, height, bpl, data))
+                print("%s: %dx%d dots, %d dpi, %d copies" % (name, width, height, dpi, copies))
+
+if __name__ == "__main__":
+    import click
+
+    @click.command()
+    @click.option('-d','--dir', 'out_dir', default=".", help="Where to save the labels")
+    @click.argument('dest')
+    def main(dest, out_dir):
+        """Pretend to be a label printer listening on DEST."""
+        listen(dest, out_dir)
+
+    main()
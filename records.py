@@ -0,0 +1,89 @@
+"""
+Read label records from a stream.
+
+A record is a dict with a "barcode" string and a "text" list of lines,
+i.e. the same thing the AMQP listener gets. Input is either JSON (one
+object per line) or CSV (barcode in the first column, one text line per
+following column). Records are yielded as they are read, so a pipe works.
+"""
+
+import csv
+import json
+
+FORMATS = ('jsonl', 'csv')
+
+def normalize(data):
+    """Return a record with a barcode string and a list of text lines."""
+    if not isinstance(data, dict):
+        raise ValueError("A label must be a JSON object, not %r" % (data,))
+    if 'barcode' not in data and 'text' not in data:
+        raise ValueError("A label needs a barcode or text: %r" % (data,))
+    barcode = data.get('barcode') or ""
+    text = data.get('text') or []
+    if isinstance(text, str):
+        text = text.split('\n')
+    res = dict(data)
+    res['barcode'] = str(barcode)
+    res['text'] = [str(t) for t in text]
+    return res
+
+def guess_format(name):
+    """Guess the record format from a file name. JSON lines is the default."""
+    if name and name.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+def read_jsonl(stream):
+    for n, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield normalize(json.loads(line))
+        except ValueError as exc:
+            raise ValueError("line %d: %s" % (n, exc)) from exc
+
+def read_csv(stream):
+    first = True
+    for row in csv.reader(stream):
+        if first:
+            first = False
+            if row and row[0].strip().lower() == 'barcode':
+                continue  # header
+        if not row:
+            continue
+        yield normalize(dict(barcode=row[0], text=row[1:]))
+
+def parse_body(body):
+    """Return the list of records in an AMQP message body: a single JSON
+    object, a JSON array of them, or one object per line."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        if '\n' not in body.strip():
+            raise
+        data = [json.loads(line) for line in body.split('\n') if line.strip()]
+    if not isinstance(data, list):
+        data = [data]
+    return [normalize(d) for d in data]
+
+def batches(data, n):
+    """Group the records from @data into lists of at most @n"""
+    batch = []
+    for rec in data:
+        batch.append(rec)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def read_records(stream, fmt=None):
+    """Yield records from @stream, which must be a text file."""
+    if fmt is None or fmt == 'auto':
+        fmt = guess_format(getattr(stream, 'name', None))
+    if fmt == 'csv':
+        return read_csv(stream)
+    if fmt == 'jsonl':
+        return read_jsonl(stream)
+    raise ValueError("Unknown record format: %r" % (fmt,))
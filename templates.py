@@ -0,0 +1,64 @@
+"""
+Label templates.
+
+A template fixes the layout of a label, so that bulk runs of labels that
+all have the same shape skip fitting each one: the font sizes and the
+height of the text are worked out once, and every label just gets its
+glyphs and bars filled in. Text that doesn't fit the template runs over.
+
+Templates are read from a JSON file that maps names to objects with
+these fields, all optional:
+
+    font_size     size of the main text
+    lines         how many lines of text to make room for
+    caption_size  size of the barcode's caption
+    sample        a record ({"barcode": ..., "text": ...}) that sizes
+                  which aren't given are fitted to
+
+Sizes are in the same units as the label editor shows. A record selects
+its template with a "template" field.
+"""
+
+import json
+
+import records
+
+FIELDS = ('font_size', 'lines', 'caption_size', 'sample')
+
+class Template:
+    def __init__(self, name, font_size=None, lines=None, caption_size=None, sample=None):
+        if sample is not None:
+            sample = records.normalize(sample)
+        if font_size is None and not (sample and sample['text']):
+            raise ValueError("Template %r needs a font_size or a sample text" % (name,))
+        if lines is None:
+            lines = len(sample['text']) if sample and sample['text'] else 1
+        self.name = name
+        self.font_size = None if font_size is None else float(font_size)
+        self.lines = int(lines)
+        self.caption_size = None if caption_size is None else float(caption_size)
+        self.sample = sample
+        self.compiled = {} # layout, by geometry; see LabelPrinter.template_layout
+
+    def __repr__(self):
+        return "<Template %s>" % (self.name,)
+
+    @classmethod
+    def from_dict(cls, name, spec):
+        if not isinstance(spec, dict):
+            raise ValueError("Template %r must be a JSON object" % (name,))
+        unknown = set(spec) - set(FIELDS)
+        if unknown:
+            raise ValueError("Template %r: unknown fields %s" % (name, ", ".join(sorted(unknown))))
+        return cls(name, **spec)
+
+def load(stream):
+    """Read templates from the JSON file @stream; returns them by name"""
+    data = json.load(stream)
+    if not isinstance(data, dict):
+        raise ValueError("Templates must be a JSON object of name: template")
+    return {name: Template.from_dict(name, spec) for name, spec in data.items()}
+
+def read(path):
+    with open(path) as f:
+        return load(f)
@@ -0,0 +1,43 @@
+import pytest
+
+import code128
+
+# symbol values worked out by hand from the Code 128 tables
+VECTORS = [
+    ("Wikipedia", [104, 55, 73, 75, 73, 80, 69, 68, 73, 65, 88, 106]),
+    # all digits, even: code set C throughout
+    ("123456", [105, 12, 34, 56, 44, 106]),
+    ("12", [105, 12, 14, 106]),
+    # trailing run of digits switches to C
+    ("AB12345678", [104, 33, 34, 99, 12, 34, 56, 78, 57, 106]),
+    # odd trailing run: one digit in B first
+    ("X12345", [104, 56, 17, 99, 23, 45, 87, 106]),
+    # inner run of six switches to C and back
+    ("A123456B", [104, 33, 99, 12, 34, 56, 100, 34, 80, 106]),
+    # inner run of four is cheaper in B
+    ("A1234B", [104, 33, 17, 18, 19, 20, 34, 90, 106]),
+]
+
+@pytest.mark.parametrize("data,values", VECTORS)
+def test_encode(data, values):
+    assert code128.encode(data) == values
+
+def test_patterns():
+    assert len(code128.PATTERNS) == 107
+    for val, p in enumerate(code128.PATTERNS):
+        assert sum(map(int, p)) == (13 if val == code128.STOP else 11), val
+
+@pytest.mark.parametrize("data,values", VECTORS)
+def test_bars(data, values):
+    bars, width = code128.bars(data)
+    assert width == 11*len(values) + 2
+    # three bars a symbol, four for stop
+    assert len(bars) == 3*len(values) + 1
+    assert bars[0] == (0, 2) # start B and C both begin with a bar two wide
+    assert bars[-1][0] + bars[-1][1] == width
+    for (pos, w), (nxt, _) in zip(bars, bars[1:]):
+        assert pos + w < nxt
+
+def test_rejects_non_ascii():
+    with pytest.raises(ValueError):
+        code128.encode("Grüße")
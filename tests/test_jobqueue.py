@@ -0,0 +1,69 @@
+import jobqueue
+
+def rec(n, prio=None):
+    r = dict(barcode=str(n), text=[])
+    if prio is not None:
+        r['priority'] = prio
+    return r
+
+def test_priority():
+    assert jobqueue.priority({}) == jobqueue.DEFAULT_PRIORITY
+    assert jobqueue.priority({'priority': "70"}) == 70
+    assert jobqueue.priority({'cups-job-priority': 5}) == 5
+    assert jobqueue.priority({'priority': 1000}) == 100
+    assert jobqueue.priority({'priority': 0}) == 1
+
+def test_bad_priority_queues_nothing():
+    q = jobqueue.JobQueue()
+    try:
+        q.put([rec(1), rec(2, "urgent")])
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+    assert len(q) == 0
+
+def test_order():
+    q = jobqueue.JobQueue()
+    q.put([rec(1), rec(2, 90), rec(3), rec(4, 90), rec(5, 10)])
+    assert [r['barcode'] for r in q.get(10)] == ["2", "4", "1", "3", "5"]
+    assert not q
+
+def test_on_ready_once_per_burst():
+    calls = []
+    q = jobqueue.JobQueue(on_ready=lambda: calls.append(1))
+    q.put([rec(1)])
+    q.put([rec(2)])
+    assert len(calls) == 1
+    q.get(1)
+    q.put([rec(3)])
+    assert len(calls) == 2
+
+def test_get_while_and_peek():
+    q = jobqueue.JobQueue()
+    q.put([rec(1), rec(1), rec(2), rec(1)])
+    assert [r['barcode'] for r in q.peek(2)] == ["1", "1"]
+    got = q.get_while(lambda r: r['barcode'] == "1", 10)
+    assert len(got) == 2
+    assert [r['barcode'] for r in q.get(10)] == ["2", "1"]
+
+def test_remove():
+    q = jobqueue.JobQueue()
+    q.put([rec(1), rec(2, 90), rec(3)])
+    removed = q.remove(lambda r: r['barcode'] != "3")
+    assert [r['barcode'] for r in removed] == ["2", "1"]
+    assert [r['barcode'] for r in q.get(10)] == ["3"]
+
+def test_full_and_wait_space():
+    q = jobqueue.JobQueue(maxsize=2)
+    q.put([rec(1), rec(2), rec(3)]) # a whole message is always taken
+    assert q.full()
+    assert q.wait_space(timeout=0.01) is False
+    q.get(2)
+    assert not q.full()
+    assert q.wait_space(timeout=0.01) is True
+
+def test_stats():
+    q = jobqueue.JobQueue(maxsize=5)
+    q.put([rec(1), rec(2, 90), rec(3)])
+    assert q.stats() == dict(depth=3, maxsize=5, priorities={50: 2, 90: 1})
@@ -0,0 +1,194 @@
+"""
+The AMQP and local listeners, against in-process stand-ins for the
+broker and the printer.
+"""
+
+import json
+import os
+import time
+
+import pytest
+
+trio = pytest.importorskip("trio")
+pytest.importorskip("cairo")
+pytest.importorskip("gi")
+pytest.importorskip("PIL")
+
+import labelprint
+from labelprint import Daemon, Listener, LocalListener
+from bench import FakeBroker, NullSink, clear_caches
+
+class SlowSink(NullSink):
+    """A printer that takes @delay seconds per label"""
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def write(self, data):
+        time.sleep(self.delay)
+        super().write(data)
+
+def daemon(sink):
+    clear_caches()
+    ui = Daemon()
+    for w in ui.workers:
+        w.prn.raw = sink
+        w.prn.set_dpi(labelprint.RAW_DPI)
+    return ui
+
+def label(i):
+    return json.dumps(dict(barcode="%08d" % (i,), text=["Item %d" % (i,)])).encode("utf-8")
+
+def listener(ui, broker, queue="labels", ack_after_print=True):
+    args = dict(host="", login="", password="", vhost="", exchange="", route="",
+        queue=queue, prefetch=20)
+    res = Listener(ui, args, connect=broker.connect)
+    res.ack_after_print = ack_after_print
+    res.RETRY_MIN = 0.05
+    return res
+
+async def idle(ui):
+    while ui.queued() or any(w.printing for w in ui.workers):
+        await trio.sleep(0.01)
+
+def test_reconnect_with_labels_printing():
+    """The daemon survives losing the broker with labels printing,
+    leaves those of the old connection to be delivered again, and
+    prints each label once more at most"""
+    n = 20
+    broker = FakeBroker()
+    sink = SlowSink(0.01)
+    ui = daemon(sink)
+    amqp = listener(ui, broker)
+
+    async def run():
+        for i in range(n):
+            broker.put("labels", label(i))
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(ui.run, [amqp])
+            while len(broker.acked) < 5:
+                await trio.sleep(0.001)
+            assert broker.unacked()
+            broker.drop()
+            with trio.fail_after(10):
+                await broker.wait_acked(n)
+                await idle(ui)
+            await trio.sleep(0.05)
+            nursery.cancel_scope.cancel()
+
+    trio.run(run)
+    assert broker.connections == 2
+    assert len(broker.acked) == n
+    assert not broker.unacked()
+    # queued labels of the old connection were dropped, not printed twice;
+    # only the one printing when it went can be
+    assert n <= sink.frames <= n+1
+
+def test_reply_after_reconnect():
+    """A message acked on receipt is still answered when its label is
+    printed after the connection it came on is gone"""
+    broker = FakeBroker()
+    ui = daemon(SlowSink(0.2))
+    amqp = listener(ui, broker, ack_after_print=False)
+
+    async def run():
+        broker.put("labels", label(1), reply_to="replies")
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(ui.run, [amqp])
+            while not broker.acked:
+                await trio.sleep(0.001)
+            broker.drop()
+            with trio.fail_after(10):
+                while not broker.published:
+                    await trio.sleep(0.01)
+            nursery.cancel_scope.cancel()
+
+    trio.run(run)
+    assert len(broker.acked) == 1
+    (key, body), = broker.published
+    assert key == "replies"
+    res = json.loads(body)
+    assert res['status'] == "ok"
+    assert [job['barcode'] for job in res['jobs']] == ["00000001"]
+
+def test_empty_message_is_answered():
+    broker = FakeBroker()
+    ui = daemon(NullSink())
+    amqp = listener(ui, broker, ack_after_print=False)
+
+    async def run():
+        broker.put("labels", b"[]", reply_to="replies")
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(ui.run, [amqp])
+            with trio.fail_after(5):
+                while not broker.published:
+                    await trio.sleep(0.01)
+            nursery.cancel_scope.cancel()
+
+    trio.run(run)
+    assert json.loads(broker.published[0][1]) == dict(status="ok", jobs=[])
+
+async def http(path, request):
+    stream = await trio.open_unix_socket(path)
+    async with stream:
+        await stream.send_all(request)
+        res = b""
+        while True:
+            data = await stream.receive_some(65536)
+            if not data:
+                break
+            res += data
+    head, _, body = res.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(body)
+
+def post(target, body):
+    return b"POST %s HTTP/1.0\r\nContent-Length: %d\r\n\r\n%s" % (target, len(body), body)
+
+def test_local_listener(tmp_path):
+    path = str(tmp_path / "labelprint.sock")
+    sink = NullSink()
+    ui = daemon(sink)
+
+    async def run():
+        res = {}
+        async with trio.open_nursery() as nursery:
+            await nursery.start(ui.run, [LocalListener(ui, path)])
+            with trio.fail_after(10):
+                res['wait'] = await http(path, post(b"/print?wait=1", label(1)))
+                res['queued'] = await http(path, post(b"/print", label(2)))
+                res['empty'] = await http(path, post(b"/print?wait=1", b"[]"))
+                res['bad'] = await http(path, post(b"/print", b"{not json"))
+                res['nolabel'] = await http(path, post(b"/print", b'{"foo": 1}'))
+                res['get'] = await http(path, b"GET /print HTTP/1.0\r\n\r\n")
+                res['missing'] = await http(path, b"GET /nothing HTTP/1.0\r\n\r\n")
+                res['queue'] = await http(path, b"GET /queue HTTP/1.0\r\n\r\n")
+                await idle(ui)
+            nursery.cancel_scope.cancel()
+        return res
+
+    res = trio.run(run)
+    code, body = res['wait']
+    assert code == 200 and body['status'] == "ok"
+    assert [job['barcode'] for job in body['jobs']] == ["00000001"]
+    code, body = res['queued']
+    assert code == 202 and body['status'] == "queued" and len(body['jobs']) == 1
+    assert res['empty'] == (200, dict(status="ok", jobs=[]))
+    assert res['bad'][0] == 400 and res['bad'][1]['status'] == "error"
+    assert res['nolabel'][0] == 400
+    assert res['get'][0] == 400
+    assert res['missing'][0] == 404
+    assert res['queue'][0] == 200 and 'queued' in res['queue'][1]
+    assert sink.frames == 2
+    assert not os.path.exists(path)
+
+def test_local_listener_leaves_other_files(tmp_path):
+    path = tmp_path / "not-a-socket"
+    path.write_text("keep me")
+    ui = daemon(NullSink())
+
+    async def run():
+        await LocalListener(ui, str(path)).listener()
+
+    with pytest.raises(OSError):
+        trio.run(run)
+    assert path.read_text() == "keep me"
@@ -0,0 +1,81 @@
+import io
+import struct
+
+import pytest
+
+import raster
+
+@pytest.fixture(params=["numpy", "python"], autouse=True)
+def packer(request, monkeypatch):
+    """Run the tests with numpy, if there is one, and without"""
+    if request.param == "numpy":
+        if raster._get_numpy() is None:
+            pytest.skip("no numpy")
+    else:
+        monkeypatch.setattr(raster, "_numpy", None)
+
+def image(rows):
+    """An RGB24 buffer (stride = 4*width) from rows of '#' and '.'"""
+    buf = bytearray()
+    for row in rows:
+        for c in row:
+            v = 0 if c == '#' else 255
+            buf += bytes((v, v, v, 0))
+    return bytes(buf), len(rows[0]), len(rows), 4*len(rows[0])
+
+ROWS = ["#.......#", ".#######."]
+
+def test_pack():
+    buf, w, h, stride = image(ROWS)
+    bpl, data = raster.pack(buf, w, h, stride)
+    assert bpl == 2
+    assert data == bytes((0b10000000, 0b10000000, 0b01111111, 0b00000000))
+
+def test_pack_align():
+    buf, w, h, stride = image(ROWS)
+    bpl, data = raster.pack(buf, w, h, stride, bytes_per_line=3, align="right")
+    assert bpl == 3
+    # 24 dots, 15 of padding on the left
+    assert data[:3] == (0b100000001).to_bytes(3, "big")
+    assert data[3:] == (0b011111110).to_bytes(3, "big")
+
+def test_frame_round_trip():
+    buf, w, h, stride = image(ROWS)
+    bpl, data = raster.pack(buf, w, h, stride)
+    f = io.BytesIO(raster.frame(w, h, bpl, data, 203, 2) * 2)
+    assert raster.read_frame(f) == (w, h, bpl, 203, 2, data)
+    assert raster.read_frame(f) == (w, h, bpl, 203, 2, data)
+    assert raster.read_frame(f) is None
+
+def test_bad_frames():
+    try:
+        raster.read_frame(io.BytesIO(b"NOPE" + bytes(raster.HEADER.size-4)))
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+    fr = raster.frame(8, 2, 1, b"\x01\x02", 203)
+    try:
+        raster.read_frame(io.BytesIO(fr[:-1]))
+    except EOFError:
+        pass
+    else:
+        assert False, "expected EOFError"
+
+def test_header_layout():
+    fr = raster.frame(9, 2, 2, b"abcd", 300, 1)
+    assert fr[:4] == b"LPR1"
+    assert struct.unpack(">IIIHH", fr[4:20]) == (9, 2, 2, 300, 1)
+
+def test_to_pbm():
+    assert raster.to_pbm(9, 2, 2, b"abcd") == b"P4\n16 2\nabcd"
+
+def test_sink_starts_files_afresh(tmp_path):
+    path = str(tmp_path / "out.raw")
+    for _ in range(2):
+        sink = raster.Sink(path)
+        sink.write(b"one")
+        sink.write(b"two")
+        sink.close()
+    with open(path, "rb") as f:
+        assert f.read() == b"onetwo"
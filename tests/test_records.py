@@ -0,0 +1,13 @@
+import pytest
+
+import records
+
+def test_normalize():
+    assert records.normalize({'barcode': 123, 'text': "a\nb"}) == {'barcode': "123", 'text': ["a", "b"]}
+    assert records.normalize({'text': ["x"]}) == {'barcode': "", 'text': ["x"]}
+    assert records.normalize({'barcode': "1"}) == {'barcode': "1", 'text': []}
+
+@pytest.mark.parametrize("data", [{'foo': 1}, [1], "label"])
+def test_normalize_rejects(data):
+    with pytest.raises(ValueError):
+        records.normalize(data)
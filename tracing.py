@@ -0,0 +1,156 @@
+"""
+Per-job traces in the Chrome trace-event format.
+
+Tracing is off until start() is called. Then span() records how long a
+piece of work took, and on which thread (the Gtk main loop, trio, or a
+worker), and interval() records what happened to a job between two of
+its time stamps, such as waiting in the queue. Events carry the IDs of
+the jobs they belong to.
+
+Events go to a JSON file that chrome://tracing and Perfetto open. It is
+written as it goes, without the closing bracket (which the viewers
+don't need), so it can be read while the program runs or after it
+crashed. When it has @max_events events it is renamed to FILE.1 (FILE.1
+to FILE.2, and so on, keeping @keep old ones) and a new one begun.
+
+While tracing is off, span() hands out one shared object that does
+nothing, and interval() returns at once.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+
+_writer = None
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL = _NullSpan()
+
+def _us(t):
+    """Trace time stamps are in microseconds; ours are time.monotonic()"""
+    return round(t*1e6, 1)
+
+class _Span:
+    __slots__ = ('writer', 'name', 'args', 'start')
+
+    def __init__(self, writer, name, args):
+        self.writer = writer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.monotonic()
+        if exc_type is not None:
+            self.args['error'] = repr(exc)
+        self.writer.event(dict(name=self.name, cat="label", ph="X",
+            ts=_us(self.start), dur=_us(end-self.start), args=self.args))
+        return False
+
+    def set(self, **args):
+        """Add to the arguments shown with the span"""
+        self.args.update(args)
+
+class Writer:
+    def __init__(self, path, max_events=100000, keep=3):
+        self.path = path
+        self.max_events = max_events
+        self.keep = keep
+        self.pid = os.getpid()
+        self.threads = {} # thread id: name, repeated in each file
+        self._lock = threading.Lock()
+        self._file = None
+        self._n = 0
+
+    def _open(self):
+        if os.path.exists(self.path):
+            for i in range(self.keep, 0, -1):
+                old = "%s.%d" % (self.path, i-1) if i > 1 else self.path
+                if os.path.exists(old):
+                    os.replace(old, "%s.%d" % (self.path, i))
+        # line buffered: every event is on disk as soon as it is written
+        self._file = open(self.path, "w", buffering=1)
+        self._file.write("[\n")
+        self._n = 0
+        for tid, name in self.threads.items():
+            self._write(self._thread_name(tid, name))
+
+    def _thread_name(self, tid, name):
+        return dict(name="thread_name", ph="M", pid=self.pid, tid=tid, args=dict(name=name))
+
+    def _write(self, ev):
+        self._file.write(json.dumps(ev, default=str))
+        self._file.write(",\n")
+        self._n += 1
+
+    def event(self, *evs):
+        """Write the events @evs, as having happened on this thread.
+        They go into the same file."""
+        tid = threading.get_ident()
+        for ev in evs:
+            ev['pid'] = self.pid
+            ev['tid'] = tid
+        with self._lock:
+            if self._file is None or self._n + len(evs) > self.max_events:
+                self.close_file()
+                self._open()
+            if tid not in self.threads:
+                self.threads[tid] = threading.current_thread().name
+                self._write(self._thread_name(tid, self.threads[tid]))
+            for ev in evs:
+                self._write(ev)
+
+    def close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self.close_file()
+
+def start(path, max_events=100000, keep=3):
+    """Trace to the file @path"""
+    global _writer
+    stop()
+    _writer = Writer(path, max_events, keep)
+    atexit.register(stop)
+
+def stop():
+    global _writer
+    w, _writer = _writer, None
+    if w is not None:
+        w.close()
+
+def enabled():
+    return _writer is not None
+
+def span(name, **args):
+    """A context manager that records the time spent in it as @name"""
+    w = _writer
+    if w is None:
+        return _NULL
+    return _Span(w, name, args)
+
+def interval(name, id, start, end, **args):
+    """Record that job @id spent from @start to @end (time.monotonic())
+    in @name. These show as a track of their own for each job."""
+    w = _writer
+    if w is None:
+        return
+    w.event(dict(name=name, cat="job", ph="b", id=id, ts=_us(start), args=args),
+        dict(name=name, cat="job", ph="e", id=id, ts=_us(end)))